@@ -0,0 +1,215 @@
+"""
+Raster based coverage checking.
+
+Testing whether a set of footprints covers an area of interest (AOI) with polygon unions and differences gets slower as
+the geometry fragments. CoverageGrid instead rasterizes the AOI and each footprint onto a grid of cells, stores the
+masks as packed bits, and answers coverage questions with numpy bit operations. The answers are exact to within one grid
+cell along the footprint edges, so choose a resolution that is small relative to the footprints.
+"""
+
+import numpy
+
+# Number of set bits in each possible byte, for counting covered cells in packed masks
+_popcount_table = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.int64)
+
+
+def _contains_xy(geometry, x, y):
+    """
+    Vectorized point in polygon test, using shapely.contains_xy where available (shapely >= 2)
+    """
+    import shapely
+    try:
+        return shapely.contains_xy(geometry, x, y)
+    except AttributeError:
+        from shapely import vectorized
+        return vectorized.contains(geometry, x, y)
+
+
+class CoverageGrid:
+    """
+    A grid of square cells over the bounding box of an AOI, on which footprints are rasterized. A cell counts as
+    covered by a footprint if the cell's center is inside the footprint.
+
+    >>> from shapely.geometry import box
+    >>> grid = CoverageGrid(box(0, 0, 10, 10), resolution=0.5)
+    >>> grid.covered_fraction([box(0, 0, 5, 10)])
+    0.5
+    >>> grid.is_covered([box(0, 0, 5, 10), box(5, 0, 10, 10)])
+    True
+    >>> grid.uncovered_polygons([box(0, 0, 5, 10)]).bounds
+    (5.0, 0.0, 10.0, 10.0)
+
+    For irregular footprints, the answers agree with the polygon union to within the cells along the edges:
+
+    >>> from shapely import affinity
+    >>> from shapely.geometry import Point
+    >>> from shapely.ops import unary_union
+    >>> aoi = Point(0, 0).buffer(10)
+    >>> footprints = [affinity.rotate(box(-12, -3, 12, 3), angle) for angle in (0, 50, 100)]
+    >>> union = unary_union(footprints)
+    >>> grid = CoverageGrid(aoi, resolution=0.05)
+    >>> abs(grid.covered_fraction(footprints) - aoi.intersection(union).area / aoi.area) < 0.001
+    True
+    >>> abs(grid.uncovered_polygons(footprints).area - aoi.difference(union).area) < 0.1
+    True
+    >>> grid.is_covered(footprints), union.contains(aoi)
+    (False, False)
+    """
+
+    def __init__(self, aoi, resolution: float):
+        """
+        :param aoi: shapely Polygon or MultiPolygon of the area of interest
+        :param resolution: Cell size, in the units of the AOI's coordinates
+        """
+        self.aoi = aoi
+        self.resolution = resolution
+        self.minx, self.miny, maxx, maxy = aoi.bounds
+        self.nx = max(int(numpy.ceil((maxx - self.minx) / resolution)), 1)
+        self.ny = max(int(numpy.ceil((maxy - self.miny) / resolution)), 1)
+        self.n_cells = self.nx * self.ny
+        self.aoi_bits = self.rasterize(aoi)
+        self.n_aoi_cells = self.count(self.aoi_bits)
+
+    def cell_centers(self, ix_start=0, ix_stop=None, iy_start=0, iy_stop=None):
+        """
+        :return: (x, y) arrays of the cell center coordinates of a window of the grid, each shaped (rows, columns)
+        """
+        ix_stop = self.nx if ix_stop is None else ix_stop
+        iy_stop = self.ny if iy_stop is None else iy_stop
+        x = self.minx + (numpy.arange(ix_start, ix_stop) + 0.5) * self.resolution
+        y = self.miny + (numpy.arange(iy_start, iy_stop) + 0.5) * self.resolution
+        return numpy.meshgrid(x, y)
+
+    def rasterize(self, geometry):
+        """
+        Rasterizes a geometry onto the grid. Only the cells within the geometry's bounding box are tested.
+
+        :param geometry: shapely Polygon or MultiPolygon
+        :return: packed bit mask (see numpy.packbits) of the cells whose centers are inside geometry
+        """
+        mask = numpy.zeros((self.ny, self.nx), dtype=bool)
+        if not geometry.is_empty:
+            minx, miny, maxx, maxy = geometry.bounds
+            ix_start = max(int(numpy.ceil((minx - self.minx) / self.resolution - 0.5)), 0)
+            ix_stop = min(int(numpy.floor((maxx - self.minx) / self.resolution - 0.5)) + 1, self.nx)
+            iy_start = max(int(numpy.ceil((miny - self.miny) / self.resolution - 0.5)), 0)
+            iy_stop = min(int(numpy.floor((maxy - self.miny) / self.resolution - 0.5)) + 1, self.ny)
+            if ix_start < ix_stop and iy_start < iy_stop:
+                x, y = self.cell_centers(ix_start, ix_stop, iy_start, iy_stop)
+                mask[iy_start:iy_stop, ix_start:ix_stop] = _contains_xy(geometry, x, y)
+        return numpy.packbits(mask.ravel())
+
+    def unpack(self, bits):
+        """
+        :return: boolean array shaped (ny, nx) from a packed bit mask
+        """
+        return numpy.unpackbits(bits, count=self.n_cells).astype(bool).reshape(self.ny, self.nx)
+
+    @staticmethod
+    def count(bits) -> int:
+        """
+        :return: Number of cells set in a packed bit mask
+        """
+        return int(_popcount_table[bits].sum())
+
+    def covered_bits(self, geometries):
+        """
+        :param geometries: Iterable of shapely geometries, e.g. a GeoSeries of footprints
+        :return: packed bit mask of the AOI cells covered by at least one of geometries
+        """
+        covered = numpy.zeros_like(self.aoi_bits)
+        for geometry in geometries:
+            covered |= self.rasterize(geometry)
+        return covered & self.aoi_bits
+
+    def covered_fraction(self, geometries=None, covered_bits=None) -> float:
+        """
+        Fraction of the AOI covered by geometries. Pass covered_bits instead if they have already been computed.
+        """
+        if covered_bits is None:
+            covered_bits = self.covered_bits(geometries)
+        if self.n_aoi_cells == 0:
+            return 1.0
+        return self.count(covered_bits & self.aoi_bits) / self.n_aoi_cells
+
+    def is_covered(self, geometries=None, covered_bits=None, threshold: float = 1.0) -> bool:
+        """
+        Whether at least threshold of the AOI is covered by geometries.
+        """
+        return self.covered_fraction(geometries, covered_bits) >= threshold
+
+    def uncovered_mask(self, geometries=None, covered_bits=None):
+        """
+        :return: boolean array shaped (ny, nx), True for cells inside the AOI that aren't covered. Row 0 is the
+        southernmost (lowest y) row.
+        """
+        if covered_bits is None:
+            covered_bits = self.covered_bits(geometries)
+        return self.unpack(self.aoi_bits & ~covered_bits)
+
+    def uncovered_polygons(self, geometries=None, covered_bits=None):
+        """
+        :return: shapely geometry of the uncovered parts of the AOI, made of whole grid cells
+        """
+        from shapely.geometry import box
+        from shapely.ops import unary_union
+        uncovered = self.uncovered_mask(geometries, covered_bits)
+        # Merge each row's runs of uncovered cells into a single box before the union, to keep the union small
+        padded = numpy.zeros((self.ny, self.nx + 2), dtype=numpy.int8)
+        padded[:, 1:-1] = uncovered
+        edges = numpy.diff(padded, axis=1)
+        run_rows, run_starts = numpy.nonzero(edges == 1)
+        run_stops = numpy.nonzero(edges == -1)[1]
+        boxes = [
+            box(self.minx + start * self.resolution, self.miny + row * self.resolution,
+                self.minx + stop * self.resolution, self.miny + (row + 1) * self.resolution)
+            for row, start, stop in zip(run_rows, run_starts, run_stops)
+        ]
+        return unary_union(boxes)
+
+    def cell_bits(self, cell: int):
+        """
+        :return: packed bit mask with only the given cell set
+        """
+        bits = numpy.zeros_like(self.aoi_bits)
+        bits[cell // 8] = 0x80 >> (cell % 8)
+        return bits
+
+    @staticmethod
+    def first_cell(bits):
+        """
+        :return: Index in the flattened grid of the first cell set in a packed bit mask, or None if none are set
+        """
+        nonzero_bytes = numpy.flatnonzero(bits)
+        if not len(nonzero_bytes):
+            return None
+        byte = nonzero_bytes[0]
+        return int(byte * 8 + numpy.argmax(numpy.unpackbits(bits[byte:byte + 1])))
+
+    def cell_center(self, cell: int):
+        """
+        :return: shapely Point at the center of a cell, given its index in the flattened grid
+        """
+        from shapely.geometry import Point
+        iy, ix = divmod(int(cell), self.nx)
+        return Point(self.minx + (ix + 0.5) * self.resolution, self.miny + (iy + 0.5) * self.resolution)
+
+
+def coverage_report(geometries, aoi, resolution: float) -> dict:
+    """
+    Summarizes how well a set of footprints covers an AOI, e.g. to report gaps before launching stereo processing.
+
+    :param geometries: Iterable of shapely geometries, e.g. StereoPairSet.pairs.geometry
+    :param aoi: shapely Polygon of the area of interest
+    :param resolution: Grid cell size, in the units of the AOI's coordinates
+    :return: dict with the covered fraction, the uncovered area (in squared coordinate units) and the uncovered parts of
+    the AOI as a shapely geometry
+    """
+    grid = CoverageGrid(aoi, resolution)
+    covered = grid.covered_bits(geometries)
+    uncovered_cells = grid.n_aoi_cells - grid.count(covered)
+    return {
+        'coverage_fraction': grid.covered_fraction(covered_bits=covered),
+        'uncovered_area': uncovered_cells * resolution ** 2,
+        'uncovered': grid.uncovered_polygons(covered_bits=covered)
+    }
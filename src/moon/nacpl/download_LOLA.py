@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 from os import path
-from clize import run
 
 def download_LOLA_for_NAC_pair(left_nac, right_nac=None, nac_dir='/data/nac'):
     """
@@ -86,5 +85,9 @@ def download_LOLA_by_bounds(minlon, minlat, maxlon, maxlat, save_dir='/data/nac'
                 file_content = requests.get(file_url).content
                 download_file.write(file_content)
 
+def main():
+    from clize import run
+    run(download_LOLA_for_NAC_pair)
+
 if __name__ == '__main__':
-    run(download_LOLA_for_NAC_pair)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,6 +1,5 @@
 # CLI tool for downloading NAC specified by product ID
 
-from clize import run
 from urllib import request
 import json
 import wget
@@ -24,15 +23,34 @@ def get_nac_url(product_id: str):
     print(nacurl)
     return nacurl
 
-def download_NAC_image(product_id, download_dir):
+def _download_to(product_id, download_dir):
+    url = get_nac_url(product_id)
+    return wget.download(url=url, out=download_dir, bar=None)
+
+def download_NAC_image(product_id, download_dir, *, cache_dir: str = None, cache_max_gb: float = None,
+                       cache_link: str = 'hard'):
     """
     Download a NAC by its product id.
 
     :param product_id: PDS id of a NAC, for example M1134059748RE
     :param download_dir: Directory into which to place the downloaded file
+    :param cache_dir: Optional shared cache directory. If the NAC has been downloaded into the cache before, it is
+    hard linked into download_dir instead of being downloaded again. See product_cache.ProductCache
+    :param cache_max_gb: Size limit of the cache in GB, beyond which least recently used NACs are evicted
+    :param cache_link: 'hard', 'copy' or 'symbolic', how the cached NAC is placed in download_dir. Hard links share the
+    read-only cached file, and fall back to a copy across file systems. Use 'copy' if later steps modify the NAC in
+    place.
     """
-    url = get_nac_url(product_id)
-    wget.download(url=url, out=download_dir, bar=None)
+    if cache_dir is None:
+        _download_to(product_id, download_dir)
+        return
+    from nacpl.product_cache import ProductCache
+    max_bytes = None if cache_max_gb is None else int(cache_max_gb * 1e9)
+    ProductCache(cache_dir, max_bytes=max_bytes).fetch(product_id, download_dir, download=_download_to, link=cache_link)
+
+def main():
+    from clize import run
+    run(download_NAC_image)
 
 if __name__ == '__main__':
-    run(download_NAC_image)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,8 +1,6 @@
-from nacpl import find_stereo_pairs, geom_helpers
-from shapely import wkt
-import clize, json, shapely
+from nacpl import find_stereo_pairs, geom_helpers, mono_selection
+import json
 
-@clize.parser.value_converter
 def list_param(arg):
     return arg.split(',')
 
@@ -16,18 +14,29 @@ def filter_nacs_mono(img_set, min_incidence=30, max_incidence=65):
     filtered_img_set = img_set.loc[(img_set.incidence_angle > min_incidence) & (img_set.incidence_angle < max_incidence), :]
     return filtered_img_set
 
-def bounding_box_mono(*, west:float, east:float, south:float, north:float, exclude: list_param=[]):
+def bounding_box_mono(*, west:float, east:float, south:float, north:float, exclude: list_param=[],
+                      ideal_incidence: float=50, plot: bool=False, manifest: bool=False, shards: int=None,
+                      search_cache: str=None):
     """
     Like find_stereo_pairs.bounding_box but finds individual NACs rather than stereo pairs. Useful for creating image
     mosaics when not also computing stereo.
+
+    :param exclude: Comma separated product ids which should not be used
+    :param ideal_incidence: Images with solar incidence angle closest to this are preferred
+    :param plot: Draw the progress of the image search, see geom_helpers.covering_set_search
+    :param manifest: Output a work manifest of {prod_id, cost} items, most expensive first, instead of a list of product
+    ids. See manifest.build_manifest
+    :param shards: With manifest, pack the images into this many shards of roughly equal total cost
+    :param search_cache: Directory in which to cache image search results, see find_stereo_pairs.bounding_box
     """
+    from shapely import wkt
     search_poly_shapely = geom_helpers.corners_to_quadrilateral(west, east, south, north, lonC0=True)
     imgs = find_stereo_pairs.ImageSearch(
-        polygon=wkt.dumps(search_poly_shapely)
+        polygon=wkt.dumps(search_poly_shapely), cache=search_cache
     )
     # imgs.results = imgs.results.filter_sun_geometry()
-    imgs.results = imgs.results.drop(exclude)
-    from_image_search(imgs)
+    from_image_search(imgs, exclude=exclude, ideal_incidence=ideal_incidence, plot=plot, manifest=manifest,
+                      shards=shards)
 
 def from_csv(filepath):
     #filepath to polygon
@@ -39,19 +48,35 @@ def from_polygon(polygon_wkt):
     imgs.results = filter_nacs_mono(imgs.results)
     from_image_search(imgs)
 
-def from_image_search(imgs):
+def from_image_search(imgs, exclude=(), ideal_incidence=50, plot=False, manifest=False, shards=None):
+    from shapely import wkt
     imgs.results = filter_nacs_mono(imgs.results)
-    search_poly_shapely = shapely.wkt.loads(imgs.search_poly)
-    imgs.results['geometry'] = imgs.results.footprint_geometry
-    # Shrink all the footprints so that there will be overlap in final steps of mosaic creation
-    imgs.results['geometry'] = imgs.results.apply(lambda row: shapely.affinity.scale(row.geometry, 0.9, 0.9, 0.9), axis=1)
-    imgs, stats = geom_helpers.covering_set_search(
-        full_poly_set=imgs.results,
+    search_poly_shapely = wkt.loads(imgs.search_poly)
+    # Footprints are shrunk during selection so that there will be overlap in final steps of mosaic creation
+    selected, stats = mono_selection.select_mono_images(
+        imgs.results,
         search_poly=search_poly_shapely,
-        verbose=False,
-        plot=True
+        exclude=exclude,
+        ideal_incidence=ideal_incidence,
+        plot=plot
     )
-    print(json.dumps(tuple(imgs.index.values)))
+    if manifest:
+        from nacpl import manifest as work_manifest
+        print(json.dumps(work_manifest.build_manifest(
+            [{'prod_id': prod_id} for prod_id in selected.index.values],
+            work_manifest.image_costs(selected),
+            shards=shards
+        )))
+    else:
+        print(json.dumps(tuple(selected.index.values)))
+    from nacpl import search_trace
+    search_trace.wait_for_rendering(stats)
+
+def main():
+    import clize
+    # Registered here rather than with a decorator so that clize is only imported when running from the command line
+    clize.parser.value_converter(list_param)
+    clize.run(bounding_box_mono, alt=from_polygon)
 
 if __name__ == '__main__':
-    clize.run(bounding_box_mono, alt=from_polygon)
\ No newline at end of file
+    main()
@@ -9,13 +9,11 @@ Aaron Curtis
 # TODO make addition of inplace parameter into a decorator
 
 
+# geopandas, pandas, numpy and shapely are imported inside the functions that use them, so that each workflow step only
+# loads the parts of the geo stack it actually needs. See import_benchmark.py.
 from nacpl import geom_helpers, load_nac_metadata
-from shapely.geometry import Polygon, LineString
-from shapely import wkt
-import geopandas, pandas
+import functools
 import re
-import numpy
-import urllib
 import json
 
 projections = {
@@ -27,8 +25,6 @@ projections = {
     'sp': '+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +a=1737400 +b=1737400 +units=m +no_defs'
 }
 
-pandas.options.mode.chained_assignment = None
-
 lblfilepath = r'/INDEX.LBL'
 indfilepath = r'/CUMINDEX.TAB'
 
@@ -47,7 +43,18 @@ def nac_url_to_id(url: str) -> str:
     return prod_id[0]
 
 
+def _import_pandas():
+    """
+    Imports pandas with the options this module relies on. Used instead of a module level import so that pandas is only
+    loaded by the steps that need it.
+    """
+    import pandas
+    pandas.options.mode.chained_assignment = None
+    return pandas
+
+
 def to_numeric_or_date(series):
+    pandas = _import_pandas()
     try:
         return pandas.to_numeric(series, errors='ignore')
     except ValueError:
@@ -66,16 +73,22 @@ def both_in_range(prop, minimum, maximum, dataframe):
 
 def find_NACs_under_trajectory(csv_file_path: str,
                                buffersize: float = 0.5,
-                               tolerance: float = 0.05) -> 'ImageSearch':
+                               tolerance: float = 0.05,
+                               **search_kwargs) -> 'ImageSearch':
     """
     Finds NAC images to cover all points in csv_file
 
     :param csv_file_path: Path to a comma separated values file in lat lon format, with header: point, lat, lon
     :param buffersize: Determines the radius of the polygon around the trajectory to search
     :param tolerance: Distance threshold for polygon simplification
+    :param search_kwargs: Passed on to ImageSearch, e.g. projection or store
     :return: An ImageSearch instance
     """
 
+    from shapely.geometry import Polygon, LineString
+    from shapely import wkt
+    pandas = _import_pandas()
+
     # Convert from csv input file to WKT buffer polygon
     df = pandas.read_csv(csv_file_path, dtype=float)
     points = df.loc[:, ['lon', 'lat']].values
@@ -84,7 +97,69 @@ def find_NACs_under_trajectory(csv_file_path: str,
     pointzone_wkt = wkt.dumps(pointzone, rounding_precision=3)
 
     # Instantiate an ImageSearch using that polygon
-    return ImageSearch(polygon=pointzone_wkt)
+    return ImageSearch(polygon=pointzone_wkt, **search_kwargs)
+
+
+# Columns of the ODE REST API results holding the footprints in each of the projections
+footprint_geometry_columns = {
+    'ec': 'footprint_geometry',
+    'sp': 'footprint_sp_geometry',
+    'np': 'footprint_np_geometry'
+}
+
+
+def polygonize(geom):
+    """
+    Upcasts a shapely LineString footprint to a shapely Polygon. Returns None if that isn't possible.
+    """
+    from shapely.geometry import Polygon
+    try:
+        return Polygon(geom)
+    except NotImplementedError:
+        print(f'Problem geometry: {geom} dropped')
+        return None
+
+
+def load_footprint_metadata(polygon: str, indfilepath=indfilepath, lblfilepath=lblfilepath,
+                            verbose: bool = False) -> 'pandas.DataFrame':
+    """
+    Queries the ODE REST API for the NAC footprints intersecting polygon, and joins the metadata in CUMINDEX.TAB.
+
+    :param polygon: WKT of the search polygon, in longitude, latitude degrees
+    :return: DataFrame indexed by product id. The footprints are WKT strings, in the columns named in
+    footprint_geometry_columns.
+    """
+    import urllib.parse
+    import urllib.request
+    pandas = _import_pandas()
+
+    pointzone_urlstring = urllib.parse.quote_plus(polygon)
+    count_url = f'http://oderest.rsl.wustl.edu/live2/?query=products&target=moon&results=c&ihid=lro&iid=lroc&pt=EDRNAC&output=JSON&limit=1000&footprint={pointzone_urlstring}&loc=f'
+    count_resp = urllib.request.urlopen(count_url)
+    count_resp = json.loads(count_resp.read())
+    count = int(count_resp['ODEResults']['Count'])
+    if verbose:
+        print(f'Found {count} NAC footprints under the trajectory, will look up their product IDs now')
+    # Not necessary to limit the footprint query using the count query, but default limit is 100 so need to set it to
+    # something; might as well be the expected number of returned footprints
+    req_url = f'http://oderest.rsl.wustl.edu/live2/?query=products&target=moon&results=pm&ihid=lro&iid=lroc&pt=EDRNAC&output=JSON&limit={count}&footprint={pointzone_urlstring}&loc=f'
+    resp = urllib.request.urlopen(req_url)
+    resp = json.loads(resp.read())
+    if verbose:
+        print(f'Looking in CUMINDEX.TAB for sun & spacecraft geometry info')
+    metadata = load_nac_metadata.load_nac_index(indfilepath=indfilepath, lblfilepath=lblfilepath)
+    metadata.product_id = metadata.product_id.apply(str.strip)
+    metadata.set_index('product_id', inplace=True)
+    footprints = pandas.DataFrame(resp['ODEResults']['Products']['Product'])
+    # lowercase all column names for ease of joining from different APIs
+    footprints.columns = [col.lower() for col in footprints.columns]
+    footprints.set_index('pdsid', inplace=True)
+    footprints = footprints.join(metadata, how='inner', lsuffix='_ode', rsuffix='')
+    # For the columns that were in common between CUMINDEX.TAB and ODE REST API, remove the ODE ones and keep the ones form CUMINDEX.TAB
+    footprints = footprints.loc[:,
+                 [col for col in footprints.columns if not col.endswith('_ode')]
+                 ]
+    return footprints.apply(to_numeric_or_date)
 
 
 def pair_id(pair):
@@ -104,17 +179,82 @@ class ImageSearch:
 
     May be initialized with a WKT string representing a polygon. In that case, it will find all footprints intersecting
     that polygon.
+
+    Polygon searches take an optional cache keyword argument: a search_cache.ImageSearchCache, a directory to keep
+    results in between runs, or True to only cache within the process. Repeated searches, and searches inside the
+    polygon of an earlier search, are then answered without querying ODE.
+
+    Polygon searches also take an optional condition_tolerance keyword argument, in meters. If given, the footprints are
+    snapped to a grid and simplified, see geom_helpers.condition_geometries, which speeds up the geometry operations in
+    StereoPairSet and covering_set_search. The vertex reduction and area error are then in conditioning_report.
+
+    Polygon searches can instead be answered offline from a prebuilt footprint_store.FootprintStore, given as the store
+    keyword argument, either as an instance or as its directory. Polar searches then run directly on the stored
+    stereographic footprints.
     """
 
     def __init__(self, *args, **kwargs):
+        cache = kwargs.pop('cache', None)
+        store = kwargs.pop('store', None)
+        condition_tolerance = kwargs.pop('condition_tolerance', None)
+        self.conditioning_report = None
         self.search_args = args
         self.search_kwargs = kwargs
+        self.projection = kwargs.get('projection', 'ec')
         if 'polygon' in kwargs.keys():
             self.search_poly = kwargs['polygon']
-            self.results = self._search_from_poly(*args, **kwargs)
+            if store is not None:
+                search = functools.partial(self._search_from_store, store)
+            else:
+                search = self._search_from_poly
+            if cache:
+                self.results = self._cached_search_from_poly(cache, search, store, *args, **kwargs)
+            else:
+                self.results = search(*args, **kwargs)
+            if condition_tolerance:
+                self.condition_footprints(condition_tolerance)
         else:
             self.results = self._search_from_bb(*args, **kwargs)
 
+    def _cached_search_from_poly(self, cache, search, store, *args, **kwargs):
+        from nacpl import search_cache
+        if not isinstance(cache, search_cache.ImageSearchCache):
+            cache = search_cache.get_cache(None if cache is True else cache)
+        if store is not None:
+            from nacpl import footprint_store
+            # Every file of the store, so that rebuilding it in place invalidates the cached searches
+            index_files = tuple(footprint_store.store_files(getattr(store, 'store_dir', store)))
+        else:
+            index_files = (kwargs.get('indfilepath', indfilepath), kwargs.get('lblfilepath', lblfilepath))
+        results = cache.get(self.search_poly, self.projection, index_files)
+        if results is None:
+            results = search(*args, **kwargs)
+            cache.put(self.search_poly, results, self.projection, index_files)
+        return results
+
+    def condition_footprints(self, tolerance: float, grid: float = None) -> dict:
+        """
+        Snaps and simplifies the footprints in results, see geom_helpers.condition_geometries.
+
+        :param tolerance: Largest distance, in meters, any footprint edge may move
+        :param grid: Size, in meters, of the grid coordinates are snapped to
+        :return: The report from geom_helpers.condition_geometries, also kept in conditioning_report
+        """
+        conditioned, self.conditioning_report = geom_helpers.condition_geometries(
+            self.results.geometry, tolerance, projection=self.projection, grid=grid
+        )
+        self.results[self.results.geometry.name] = conditioned
+        return self.conditioning_report
+
+    def _search_from_store(self, store, polygon: str, projection: str = 'ec', verbose: bool = False, **_):
+        from nacpl import footprint_store
+        if not isinstance(store, footprint_store.FootprintStore):
+            store = footprint_store.FootprintStore(store)
+        results = store.search(polygon, projection)
+        if verbose:
+            print(f'Found {len(results)} NAC footprints in the footprint store at {store.store_dir}')
+        return results
+
     @staticmethod
     def _search_from_poly(polygon: str,
                           indfilepath=indfilepath,  # TODO need better solution than hardcoding path to local files
@@ -126,47 +266,14 @@ class ImageSearch:
         :param str projection: The projection to use. Should be 'ec' for lat / lon equidistant cylindrical, 'sp' for
         south polar, 'np' for north polar. 
         """
-        pointzone_urlstring = urllib.parse.quote_plus(polygon)
-        count_url = f'http://oderest.rsl.wustl.edu/live2/?query=products&target=moon&results=c&ihid=lro&iid=lroc&pt=EDRNAC&output=JSON&limit=1000&footprint={pointzone_urlstring}&loc=f'
-        count_resp = urllib.request.urlopen(count_url)
-        count_resp = json.loads(count_resp.read())
-        count = int(count_resp['ODEResults']['Count'])
-        if verbose:
-            print(f'Found {count} NAC footprints under the trajectory, will look up their product IDs now')
-        # Not necessary to limit the footprint query using the count query, but default limit is 100 so need to set it to
-        # something; might as well be the expected number of returned footprints
-        req_url = f'http://oderest.rsl.wustl.edu/live2/?query=products&target=moon&results=pm&ihid=lro&iid=lroc&pt=EDRNAC&output=JSON&limit={count}&footprint={pointzone_urlstring}&loc=f'
-        resp = urllib.request.urlopen(req_url)
-        resp = json.loads(resp.read())
-        if verbose:
-            print(f'Looking in CUMINDEX.TAB for sun & spacecraft geometry info')
-        metadata = load_nac_metadata.load_nac_index(indfilepath=indfilepath, lblfilepath=lblfilepath)
-        metadata.product_id = metadata.product_id.apply(str.strip)
-        metadata.set_index('product_id', inplace=True)
-        footprints = pandas.DataFrame(resp['ODEResults']['Products']['Product'])
-        # lowercase all column names for ease of joining from different APIs
-        footprints.columns = [col.lower() for col in footprints.columns]
-        footprints.set_index('pdsid', inplace=True)
-        footprints = footprints.join(metadata, how='inner', lsuffix='_ode', rsuffix='')
-        # For the columns that were in common between CUMINDEX.TAB and ODE REST API, remove the ODE ones and keep the ones form CUMINDEX.TAB
-        footprints = footprints.loc[:,
-                     [col for col in footprints.columns if not col.endswith('_ode')]
-                     ]
-        footprints = footprints.apply(to_numeric_or_date)
+        import geopandas
+        from shapely import wkt
 
+        footprints = load_footprint_metadata(polygon, indfilepath=indfilepath, lblfilepath=lblfilepath,
+                                             verbose=verbose)
+        # IAU2000:30101 for ec, IAU2000:30120 for sp, IAU2000:30118 for np
         crs = projections[projection]
-        if projection == 'ec':
-            # Use IAU2000:30101
-            crs = '+proj=longlat +a=1737400 +b=1737400 +no_defs'
-            footprints.footprint_geometry = footprints.footprint_geometry.apply(wkt.loads)
-        elif projection == 'sp':
-            # Use IAU2000:30120
-            crs = '+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +a=1737400 +b=1737400 +units=m +no_defs'
-            footprints.footprint_geometry = footprints.footprint_sp_geometry.apply(wkt.loads)
-        elif projection == 'np':
-            # Use IAU2000:30118
-            crs = '+proj=stere +lat_0=90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +a=1737400 +b=1737400 +units=m +no_defs'
-            footprints.footprint_geometry = footprints.footprint_np_geometry.apply(wkt.loads)
+        footprints.footprint_geometry = footprints[footprint_geometry_columns[projection]].apply(wkt.loads)
 
         if verbose:
             print(f'{len(footprints)} NACs were listed in the CUMINDEX.TAB file')
@@ -174,18 +281,11 @@ class ImageSearch:
         footprints.crs = crs
         footprints.geometry = footprints.footprint_geometry
 
-        # Upcast from shapely LineString to shapely Polygon
-        def polygonize(geom):
-            try:
-                return Polygon(geom)
-            except NotImplementedError:
-                print(f'Problem geometry: {geom} dropped')
-                return None
-
         footprints.footprint_geometry = footprints.footprint_geometry.apply(
             polygonize
         )
-        footprints.crs = '+proj=longlat +a=1737400 +b=1737400 +no_defs'
+        # Keep the CRS of the projection the footprints are in, so that nothing downstream needs to reproject them
+        footprints.crs = crs
         return footprints.dropna()
 
     def date_range(self):
@@ -232,22 +332,39 @@ class StereoPairSet:
 
     """
 
-    def __init__(self, imagesearch: ImageSearch = None, pairs=None, projection: str = 'ec'):
+    def __init__(self, imagesearch: ImageSearch = None, pairs=None, projection: str = None, workers: int = None,
+                 shard_method: str = 'grid', prefilter=None):
+        """
+        :param projection: Projection of the footprint coordinates, one of the keys of projections. Defaults to the
+        projection of imagesearch, or 'ec'.
+        :param workers: Number of processes to build the pairs with, for searches with thousands of footprints. See
+        pair_geometry.overlap_geometries
+        :param shard_method: How to divide the footprints between workers, 'grid' or 'str'. See
+        pair_geometry.shard_regions
+        :param prefilter: Quality thresholds pairs of images must meet before their footprints are intersected: a dict
+        as described in pair_quality.QualityMatrix, or True for pair_quality.default_thresholds, which match the
+        defaults of filter_sun_geometry. Pruning incompatible pairs first saves most of the geometry work.
+        """
+        self.projection = projection or getattr(imagesearch, 'projection', 'ec')
         # If StereoPairSet is instantiated with another StereoPairSet, copy the pairs
         if pairs is not None:
             self.pairs = pairs
         elif imagesearch is not None:
+            from nacpl import pair_geometry
+            _import_pandas()
             gdf = imagesearch.results.dropna()
             gdf[
                 'prod_id'] = gdf.index  # Store index (product id) in column so that it's preserved in spatial join operation
-            self.pairs = geopandas.overlay(gdf, gdf, how='union', keep_geom_type=True)
-            # If we're in lat lon, then need to convert to meters before calculating area
-            if projection == 'ec':
-                pairs_eqc = self.pairs.to_crs(
-                    "+proj=eqc +lat_0=0 +lon_0=0 +x_0=0 +y_0=0 +a=1737400 +b=1737400 +units=m +no_defs"
-                )
-            self.pairs['area_m2'] = pairs_eqc.area  # Store area as column before sorting (could use key fn instead...)
-            self.pairs.sort_values('area_m2', ascending=False, inplace=True)
+            if prefilter is True:
+                from nacpl import pair_quality
+                prefilter = pair_quality.default_thresholds
+            self.pairs = pair_geometry.build_pairs(gdf, workers=workers, shard_method=shard_method,
+                                                   prefilter=prefilter)
+            # Area on the sphere, computed from the coordinates in whichever projection they're in
+            self.pairs['area_m2'] = geom_helpers.spherical_area(
+                self.pairs.geometry.values, projection=self.projection
+            )  # Store area as column before sorting (could use key fn instead...)
+            self.pairs.sort_values('area_m2', ascending=False, inplace=True, kind='mergesort')
             self.filter_unique(
                 inplace=True)  # TODO pair_id is created inside this method call -- maybe not the best place for that
             self.pairs.set_index('pair_id', inplace=True)
@@ -265,7 +382,7 @@ class StereoPairSet:
         filtered_pairs = self.pairs[(self.pairs.start_time_1 > since) | (self.pairs.start_time_2 > since)]
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_date_range(self, startime, endtime, inplace: bool = True) -> 'StereoPairSet':
         """
@@ -278,7 +395,7 @@ class StereoPairSet:
         filtered_pairs = both_in_range('start_time', minimum=startime, maximum=endtime, dataframe=self.pairs)
         if inplace:
             filtered_pairs = self.pairs[filtered_pairs]
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_sufficient_convergence(self, min_convergence: float = 2, inplace: bool = True) -> 'StereoPairSet':
         """
@@ -287,11 +404,12 @@ class StereoPairSet:
         :param min_convergence: Convergence angle beneath which to remove pair
         :return: StereoPairSet with pairs that have insufficient convergence removed.
         """
+        from nacpl import pair_quality
         filtered_pairs = self.pairs[
-            numpy.abs(self.pairs.emission_angle_1 - self.pairs.emission_angle_2) > min_convergence]
+            pair_quality.convergence(self.pairs.emission_angle_1, self.pairs.emission_angle_2) > min_convergence]
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_sun_geometry(self, max_sun_azimuth_ground_difference: float = 20,
                             max_incidence_angle_difference: float = 20,
@@ -303,16 +421,18 @@ class StereoPairSet:
         :param inplace: Replace .pairs of this StereoPairSet instance with the filtered version
         :return: StereoPairSet of pairs with bad sun geometry pairs removed.
         """
-        big_incidence_diff = numpy.abs(
-            self.pairs.incidence_angle_1 - self.pairs.incidence_angle_2) < max_incidence_angle_difference
-        sub_solar_ground_az_1 = self.pairs.north_azimuth_1 - self.pairs.sub_solar_azimuth_1
-        sub_solar_ground_az_2 = self.pairs.north_azimuth_2 - self.pairs.sub_solar_azimuth_2
-        sub_solar_ground_az_diff = numpy.abs(sub_solar_ground_az_1 - sub_solar_ground_az_2)
+        from nacpl import pair_quality
+        big_incidence_diff = pair_quality.incidence_angle_difference(
+            self.pairs.incidence_angle_1, self.pairs.incidence_angle_2) < max_incidence_angle_difference
+        sub_solar_ground_az_diff = pair_quality.sun_azimuth_ground_difference(
+            self.pairs.north_azimuth_1, self.pairs.sub_solar_azimuth_1,
+            self.pairs.north_azimuth_2, self.pairs.sub_solar_azimuth_2
+        )
         big_sunaz_diff = sub_solar_ground_az_diff < max_sun_azimuth_ground_difference
         filtered_pairs = self.pairs[big_incidence_diff & big_sunaz_diff]
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_small_overlaps(self, min_area: float = 50000000, inplace: bool = True) -> 'StereoPairSet':
         """
@@ -321,10 +441,14 @@ class StereoPairSet:
         :param inplace: Replace .pairs of this StereoPairSet instance with the filtered version
         :return: StereoPairSet with small-overlap pairs removed.
         """
-        filtered_pairs = self.pairs[self.pairs.area_m2 > min_area]
+        pairs = self.pairs
+        if 'area_m2' not in pairs:
+            # Added to a copy, so that self.pairs is left unchanged unless inplace
+            pairs = pairs.assign(area_m2=geom_helpers.spherical_area(pairs.geometry.values, projection=self.projection))
+        filtered_pairs = pairs[pairs.area_m2 > min_area]
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_unique(self, inplace: bool = True) -> 'StereoPairSet':
         """
@@ -332,6 +456,7 @@ class StereoPairSet:
         :param inplace: Replace .pairs of this StereoPairSet instance with the filtered version
         :return: StereoPairSet with self-pairs removed.
         """
+        _import_pandas()
         filtered_pairs = self.pairs[self.pairs.loc[:, 'prod_id_1'] != self.pairs.loc[:, 'prod_id_2']]
         # Remove flipped-pair-order pairs (e.g. M1234LxxM4567L where M4567LxxM1234L exists in the same dataset)
         # First, create a column of pair ids, always with the low number first
@@ -339,7 +464,7 @@ class StereoPairSet:
         filtered_pairs.drop_duplicates(subset='pair_id', inplace=True)
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
     def filter_incidence(self, inplace: bool = True) -> 'StereoPairSet':
         """
@@ -353,9 +478,9 @@ class StereoPairSet:
         # TODO maybe add phase angle
         if inplace:
             self.pairs = filtered_pairs
-        return StereoPairSet(pairs=filtered_pairs)
+        return StereoPairSet(pairs=filtered_pairs, projection=self.projection)
 
-    def stereo_quality(self) -> pandas.DataFrame:
+    def stereo_quality(self) -> 'pandas.DataFrame':
         """
         Calculates quality metrics for stereo pairs based on:
             Becker et al. 2015. "Criteria for Automated Identification of Stereo Image Pairs."
@@ -363,30 +488,20 @@ class StereoPairSet:
         :param pair: A geodataframe as returned from find_stereo_pairs.overlaps()
         :return: A dataframe of stereo quality metrics indexed using the prod_id
         """
+        from nacpl import pair_quality
+        pandas = _import_pandas()
         pairs = self.pairs
         metrics = pandas.DataFrame(
             columns=['Resolution ratio', 'Parallax/height ratio', 'Shadow tip distance'],
             index=pairs.index
         )
 
-        resolutions = pairs.loc[:, ['resolution_1',
-                                    'resolution_2']].to_numpy()  # Converting to numpy for sorting because Pandas can't do this kind of sort
-        resolutions.sort()  # numpy does things inplace
-        metrics['Resolution ratio'] = resolutions[:, 1] / resolutions[:, 0]
-
-        px1 = - numpy.tan(pairs.emission_angle_1) * numpy.cos(pairs.north_azimuth_1)  # parallax x, image 1
-        py1 = numpy.tan(pairs.emission_angle_1) * numpy.sin(pairs.north_azimuth_1)  # parallax y, image 1
-        px2 = - numpy.tan(pairs.emission_angle_2) * numpy.cos(pairs.north_azimuth_2)  # parallax x, image 2
-        py2 = numpy.tan(pairs.emission_angle_2) * numpy.sin(pairs.north_azimuth_2)  # parallax y, image 2
-        metrics['Parallax/height ratio'] = ((px1 - px2) ** 2 + (
-                py1 - py2) ** 2) ** 0.5  # related to convergence angle ("stereo strength")
-
-        shx1 = - numpy.tan(pairs.incidence_angle_1) * numpy.cos(pairs.sub_solar_azimuth_1)
-        shy1 = numpy.tan(pairs.incidence_angle_1) * numpy.sin(pairs.sub_solar_azimuth_1)
-        shx2 = - numpy.tan(pairs.incidence_angle_2) * numpy.cos(pairs.sub_solar_azimuth_2)
-        shy2 = numpy.tan(pairs.incidence_angle_2) * numpy.sin(pairs.sub_solar_azimuth_2)
-        metrics['Shadow tip distance'] = ((shx1 - shx2) ** 2 + (
-                shy1 - shy2) ** 2) ** 0.5  # Shadow-tip distance (measure of illumination compatibility)
+        metrics['Resolution ratio'] = pair_quality.resolution_ratio(
+            pairs.resolution_1.to_numpy(), pairs.resolution_2.to_numpy())
+        metrics['Parallax/height ratio'] = pair_quality.parallax_height_ratio(
+            pairs.emission_angle_1, pairs.north_azimuth_1, pairs.emission_angle_2, pairs.north_azimuth_2)
+        metrics['Shadow tip distance'] = pair_quality.shadow_tip_distance(
+            pairs.incidence_angle_1, pairs.sub_solar_azimuth_1, pairs.incidence_angle_2, pairs.sub_solar_azimuth_2)
 
         limits = {
             'Resolution ratio': (0, 4),  # Paper recommends
@@ -411,6 +526,7 @@ class StereoPairSet:
         :param plot: Toggle pair plot
         :param polygon: A polygon in which find_covering_set will search
         """
+        from shapely import wkt
         # Convert from WKT string to shapely
         polygon = wkt.loads(polygon)
         west, south, east, north = polygon.bounds
@@ -429,17 +545,56 @@ class StereoPairSet:
         self.pairs.plot(edgecolor='grey')
         pyplot.show()
 
-    def pairs_json(self) -> str:
-        pair_ids = self.pairs.index.drop_duplicates()
+    def pairs_json(self, manifest: bool = False, order: str = 'lpt', shards: int = None) -> str:
+        """
+        :param manifest: Output a work manifest with a cost estimate for each pair, see manifest.build_manifest.
+        Otherwise, output a plain list of {left, right} pairs.
+        :param order: For manifests, 'lpt' to list the most expensive pairs first, or None to keep the pair order
+        :param shards: For manifests, pack the pairs into this many shards of roughly equal total cost
+        :return: JSON string
+        """
+        unique_pairs = self.pairs[~self.pairs.index.duplicated()]
         pairs_dict = [
             {'left': f'{pair_id.split("xx")[0]}',
              'right': f'{pair_id.split("xx")[1]}'}
-            for pair_id in pair_ids
+            for pair_id in unique_pairs.index
         ]
+        if manifest:
+            from nacpl import manifest as work_manifest
+            return json.dumps(work_manifest.build_manifest(
+                pairs_dict, work_manifest.pair_costs(unique_pairs), order=order, shards=shards
+            ))
         return json.dumps(list(pairs_dict))
 
 
-def trajectory(trajectory_csv: str, plot: bool = False, find_covering: bool = False, verbose=False) -> 'StereoPairSet':
+def report_coverage(stats: dict, pairs=None, search_poly=None, coverage_resolution: float = None,
+                    projection: str = 'ec') -> None:
+    """
+    Prints the coverage achieved by a covering set search, and any gaps, to stderr so that stdout remains valid JSON.
+
+    :param stats: stats as returned by geom_helpers.covering_set_search
+    :param pairs: The selected pairs
+    :param search_poly: shapely Polygon that was searched, in the coordinates of projection
+    :param coverage_resolution: If given, the coverage of the selected pairs is measured on a grid of this cell size,
+    see coverage.coverage_report, and the uncovered area and gaps are reported too
+    :param projection: Projection of pairs and search_poly
+    """
+    import sys
+    if coverage_resolution is None:
+        print(f'Covering set covers {stats["coverage_fraction"]:.4f} of the search area', file=sys.stderr)
+        return
+    from nacpl import coverage
+    report = coverage.coverage_report(pairs.geometry.values, search_poly, coverage_resolution)
+    units = 'degrees' if projection == 'ec' else 'meters'
+    print(f'Covering set covers {report["coverage_fraction"]:.4f} of the search area, leaving '
+          f'{report["uncovered_area"]:.6g} square {units} uncovered', file=sys.stderr)
+    if not report['uncovered'].is_empty:
+        print(f'Uncovered: {report["uncovered"].wkt}', file=sys.stderr)
+
+
+def trajectory(trajectory_csv: str, plot: bool = False, find_covering: bool = False, verbose=False,
+               coverage_resolution: float = None, manifest: bool = False, shards: int = None, projection: str = 'ec',
+               store: str = None) -> 'StereoPairSet':
     """
     Find stereo pairs beneath a trajectory of points
 
@@ -447,27 +602,50 @@ def trajectory(trajectory_csv: str, plot: bool = False, find_covering: bool = Fa
     :param plot: Whether to output a plot of the pairs
     :param find_covering: Whether to search for a minimal set of pairs covering the trajectory. Otherwise, outputs all
     pairs that have good sun and spacecraft geometry.
+    :param verbose: Report any parts of the trajectory the covering set doesn't cover, on stderr
+    :param coverage_resolution: Grid cell size, in the units of projection (degrees for ec, meters for np and sp), for
+    tracking coverage during the covering set search and measuring the gaps reported with verbose. See
+    geom_helpers.covering_set_search and coverage.coverage_report
+    :param manifest: Output a work manifest with per pair cost estimates, most expensive first, instead of a plain list
+    of pairs. See StereoPairSet.pairs_json
+    :param shards: With manifest, pack the pairs into this many shards of roughly equal total cost
+    :param projection: Projection to find pairs in: 'ec', or 'np' / 'sp' for polar stereographic, near the poles. See
+    projections
+    :param store: Directory of a footprint_store.FootprintStore to search instead of ODE and CUMINDEX.TAB
     :return: A StereoPairSet
     """
     # TODO: implement plotting
-    imgs = find_NACs_under_trajectory(csv_file_path=trajectory_csv)
-    pairset = StereoPairSet(imgs)
+    from shapely import wkt
+    imgs = find_NACs_under_trajectory(csv_file_path=trajectory_csv, projection=projection, store=store)
+    pairset = StereoPairSet(imgs, prefilter=True)
     filtered_pairset = pairset.filter_sun_geometry().filter_small_overlaps()
     if find_covering:
-        search_poly_shapely = wkt.loads(imgs.search_poly)
+        # The pair footprints are in the coordinates of projection, so the search polygon must be too
+        search_poly_shapely = geom_helpers.lonlat_polygon_to_projection(wkt.loads(imgs.search_poly), projection)
         filtered_pairset.pairs, stats = geom_helpers.covering_set_search(
             full_poly_set=filtered_pairset.pairs,
             search_poly=search_poly_shapely,
             plot=plot,
-            verbose=False
+            verbose=False,
+            coverage_resolution=coverage_resolution,
+            projection=filtered_pairset.projection
         )
-    print(filtered_pairset.pairs_json())
+        if verbose:
+            report_coverage(stats, filtered_pairset.pairs, search_poly_shapely, coverage_resolution,
+                            filtered_pairset.projection)
+    print(filtered_pairset.pairs_json(manifest=manifest, shards=shards))
+    if find_covering:
+        from nacpl import search_trace
+        search_trace.wait_for_rendering(stats)
     return filtered_pairset
 
 
 def bounding_box(*, west: float, east: float, south: float, north: float, plot: bool = False,
                  find_covering: bool = True,
-                 return_pairset: bool = False, verbose=False) -> 'StereoPairSet':
+                 return_pairset: bool = False, verbose=False, coverage_resolution: float = None,
+                 manifest: bool = False, shards: int = None, search_cache: str = None,
+                 condition_tolerance: float = None, workers: int = None, projection: str = 'ec',
+                 store: str = None) -> 'StereoPairSet':
     """
     Find stereo pairs that fill a given bounding box
     
@@ -478,27 +656,65 @@ def bounding_box(*, west: float, east: float, south: float, north: float, plot:
     :param plot: Whether to plot the footprints of the selected images
     :param find_covering: Whether to search for a minimal set of pairs covering the bounding box. Otherwise, outputs all
     pairs that have good sun and spacecraft geometry.
+    :param verbose: Report any parts of the bounding box the covering set doesn't cover, on stderr
+    :param coverage_resolution: Grid cell size, in the units of projection (degrees for ec, meters for np and sp), for
+    tracking coverage during the covering set search and measuring the gaps reported with verbose. See
+    geom_helpers.covering_set_search and coverage.coverage_report
+    :param manifest: Output a work manifest with per pair cost estimates, most expensive first, instead of a plain list
+    of pairs. See StereoPairSet.pairs_json
+    :param shards: With manifest, pack the pairs into this many shards of roughly equal total cost
+    :param search_cache: Directory in which to cache image search results, so that repeated or nested bounding boxes
+    don't query ODE again. See search_cache.ImageSearchCache
+    :param condition_tolerance: Simplify footprints so that no edge moves more than this many meters, to speed up
+    finding pairs. With verbose, the vertex reduction and area error are reported on stderr. See
+    geom_helpers.condition_geometries
+    :param workers: Number of processes to find the overlapping pairs with, for large (e.g. polar) searches
+    :param projection: Projection to find pairs in: 'ec', or 'np' / 'sp' for polar stereographic, near the poles. See
+    projections
+    :param store: Directory of a footprint_store.FootprintStore to search instead of ODE and CUMINDEX.TAB
     :return: A StereoPairSet
     """
 
+    from shapely import wkt
     search_poly_shapely = geom_helpers.corners_to_quadrilateral(west, east, south, north, lonC0=True)
-    imgs = ImageSearch(polygon=wkt.dumps(search_poly_shapely))
-    pairset = StereoPairSet(imgs)
+    imgs = ImageSearch(polygon=wkt.dumps(search_poly_shapely), cache=search_cache,
+                       condition_tolerance=condition_tolerance, projection=projection, store=store)
+    if verbose and imgs.conditioning_report is not None:
+        import sys
+        report = imgs.conditioning_report
+        print(f'Footprint vertices reduced from {report["vertices_before"]} to {report["vertices_after"]}, largest '
+              f'area change {report["max_area_error_m2"]:.0f} m^2 ({report["max_relative_area_error"]:.2%})',
+              file=sys.stderr)
+    # Prune pairs with incompatible sun geometry before intersecting footprints, with the thresholds filter_sun_geometry
+    # applies below
+    pairset = StereoPairSet(imgs, workers=workers, prefilter=True)
     filtered_pairset = pairset.filter_sun_geometry().filter_small_overlaps()
     if find_covering:
-        search_poly_shapely = wkt.loads(imgs.search_poly)
+        # The pair footprints are in the coordinates of projection, so the search polygon must be too
+        search_poly_shapely = geom_helpers.lonlat_polygon_to_projection(wkt.loads(imgs.search_poly), projection)
         filtered_pairset.pairs, stats = geom_helpers.covering_set_search(
             full_poly_set=filtered_pairset.pairs,
             search_poly=search_poly_shapely,
             plot=plot,
-            verbose=False
+            verbose=False,
+            coverage_resolution=coverage_resolution,
+            projection=filtered_pairset.projection
         )
-    print(filtered_pairset.pairs_json())
+        if verbose:
+            report_coverage(stats, filtered_pairset.pairs, search_poly_shapely, coverage_resolution,
+                            filtered_pairset.projection)
+    print(filtered_pairset.pairs_json(manifest=manifest, shards=shards))
+    if find_covering:
+        from nacpl import search_trace
+        search_trace.wait_for_rendering(stats)
     if return_pairset:
         return filtered_pairset
 
 
-if __name__ == '__main__':
-    import clize, json
-
+def main():
+    import clize
     clize.run(bounding_box, alt=trajectory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""
+Prebuilt store of NAC footprints and metadata, for answering ImageSearch polygon searches without querying ODE, reading
+CUMINDEX.TAB or parsing WKT.
+
+Layout of the store directory:
+
+    store.json  the polygon the store was built from and the projections it holds
+    attributes.pkl  metadata of every product, as joined from ODE and CUMINDEX.TAB, indexed by product id
+    ec/, np/, sp/  one directory per projection, holding footprints in that projection's coordinates:
+        wkb.npy  the footprints as WKB, concatenated into one uint8 array
+        offsets.npy  start of each footprint in wkb.npy, followed by the end of the last one
+        rows.npy  position in attributes of each footprint
+        tree_bounds.npy, tree_levels.npy, tree_items.npy  packed STR (Sort-Tile-Recursive) tree over the footprints'
+            bounding boxes, see build_str_tree
+
+The arrays are memory mapped when a store is opened, so opening is cheap and a search only reads the pages it touches.
+Polar searches run in stereographic coordinates throughout: the search polygon is projected, rather than every
+footprint. The store only knows about products released before it was built, so rebuild it after each PDS release.
+
+>>> import numpy
+>>> bounds = numpy.array([[x, 0, x + 1, 1] for x in range(100)], dtype=float)
+>>> tree = build_str_tree(bounds, node_size=4)
+>>> sorted(query_str_tree(*tree, node_size=4, box=(10.5, 0.5, 12.5, 0.6)).tolist())
+[10, 11, 12]
+
+Tree queries find the same boxes as testing every box, and store searches the same footprints as intersecting the search
+polygon with every footprint:
+
+>>> random = numpy.random.RandomState(0)
+>>> corners = random.uniform(0, 100, size=(1000, 2))
+>>> bounds = numpy.hstack([corners, corners + random.uniform(0, 5, size=(1000, 2))])
+>>> query_box = (20, 30, 40, 35)
+>>> brute_force = numpy.flatnonzero((bounds[:, 0] <= query_box[2]) & (bounds[:, 2] >= query_box[0]) &
+...                                 (bounds[:, 1] <= query_box[3]) & (bounds[:, 3] >= query_box[1]))
+>>> sorted(query_str_tree(*build_str_tree(bounds), box=query_box).tolist()) == brute_force.tolist()
+True
+>>> import pandas
+>>> import tempfile
+>>> from shapely import affinity
+>>> from shapely.geometry import box
+>>> footprints = [affinity.rotate(box(lon, lat, lon + 0.5, lat + 2), angle) for lon, lat, angle in zip(
+...     random.uniform(0, 360, 500), random.uniform(-88, -72, 500), random.uniform(-10, 10, 500))]
+>>> sp_footprints = [geom_helpers.lonlat_polygon_to_projection(footprint, 'sp') for footprint in footprints]
+>>> store_dir = tempfile.mkdtemp()
+>>> build_store(store_dir, pandas.DataFrame(
+...     {'footprint_geometry': [footprint.wkt for footprint in footprints],
+...      'footprint_sp_geometry': [footprint.wkt for footprint in sp_footprints]},
+...     index=pandas.Index([f'M{position:09d}L' for position in range(500)], name='pdsid')
+... ), polygon=box(0, -90, 360, -70).wkt, projections=('ec', 'sp'))
+>>> search = box(100, -85, 160, -78)
+>>> sp_search = geom_helpers.lonlat_polygon_to_projection(search, 'sp')
+>>> store = FootprintStore(store_dir)
+>>> for projection, query, projected in (('ec', search, footprints), ('sp', sp_search, sp_footprints)):
+...     expected = [f'M{position:09d}L' for position, footprint in enumerate(projected) if footprint.intersects(query)]
+...     print(projection, len(expected) > 0, sorted(store.search(search.wkt, projection).index) == expected)
+ec True True
+sp True True
+
+Searches reaching outside the polygon the store was built from are refused, rather than returning partial results:
+
+>>> store.search(box(100, -75, 160, -65).wkt)  # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+ValueError: Search polygon extends outside the polygon footprint store ... was built from, ...
+"""
+
+from nacpl import geom_helpers
+import json
+import os
+import pickle
+
+# Items per node of the STR trees
+node_size = 16
+
+
+def build_str_tree(bounds, node_size: int = node_size):
+    """
+    Builds a packed STR tree: the boxes are sorted into slices by x, then by y within each slice, and every node_size
+    consecutive boxes of a level are grouped into a node of the level above, until one node is left.
+
+    :param bounds: numpy array of (minx, miny, maxx, maxy) rows
+    :param node_size: Children per node
+    :return: (tree_bounds, tree_levels, tree_items) tree_bounds holds the boxes of every level, leaves first, and
+    tree_levels the position in tree_bounds where each level starts, followed by the length of tree_bounds. tree_items holds the
+    position in bounds of each leaf.
+    """
+    import numpy
+    bounds = numpy.asarray(bounds, dtype=float).reshape(-1, 4)
+    n_items = len(bounds)
+    n_slices = max(int(numpy.ceil(numpy.sqrt(numpy.ceil(n_items / node_size)))), 1)
+    slice_size = n_slices * node_size
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    by_x = numpy.argsort(center_x, kind='mergesort')
+    items = numpy.concatenate([
+        by_x[start:start + slice_size][numpy.argsort(center_y[by_x[start:start + slice_size]], kind='mergesort')]
+        for start in range(0, n_items, slice_size)
+    ] or [numpy.empty(0, dtype=int)])
+
+    levels = [bounds[items]]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        starts = numpy.arange(0, len(below), node_size)
+        levels.append(numpy.column_stack([
+            numpy.minimum.reduceat(below[:, 0], starts), numpy.minimum.reduceat(below[:, 1], starts),
+            numpy.maximum.reduceat(below[:, 2], starts), numpy.maximum.reduceat(below[:, 3], starts)
+        ]))
+    tree_levels = numpy.concatenate([[0], numpy.cumsum([len(level) for level in levels])])
+    return numpy.concatenate(levels), tree_levels, items
+
+
+def query_str_tree(tree_bounds, tree_levels, tree_items, box, node_size: int = node_size):
+    """
+    :param box: (minx, miny, maxx, maxy) to search
+    :return: numpy array of the positions, in the bounds the tree was built from, of boxes intersecting box
+    """
+    import numpy
+    minx, miny, maxx, maxy = box
+    n_levels = len(tree_levels) - 1
+    if n_levels == 0 or tree_levels[-1] == 0:
+        return numpy.empty(0, dtype=int)
+    # Start from the root, which is the only node of the top level
+    nodes = numpy.zeros(1, dtype=int)
+    for level in range(n_levels - 1, -1, -1):
+        level_bounds = tree_bounds[tree_levels[level] + nodes]
+        hit = (
+                (level_bounds[:, 0] <= maxx) & (level_bounds[:, 2] >= minx) &
+                (level_bounds[:, 1] <= maxy) & (level_bounds[:, 3] >= miny)
+        )
+        nodes = nodes[hit]
+        if level > 0:
+            children = (nodes[:, None] * node_size + numpy.arange(node_size)).ravel()
+            nodes = children[children < tree_levels[level] - tree_levels[level - 1]]
+    return numpy.asarray(tree_items[nodes])
+
+
+def build_store(store_dir: str, footprints, polygon: str = None, projections=('ec', 'np', 'sp')) -> None:
+    """
+    Writes a footprint store.
+
+    :param store_dir: Directory to write the store to
+    :param footprints: DataFrame of footprints and metadata as returned by find_stereo_pairs.load_footprint_metadata
+    :param polygon: WKT of the polygon footprints was searched with, recorded in store.json
+    :param projections: Projections to store footprints for
+    """
+    import numpy
+    from shapely import wkt
+    from nacpl import find_stereo_pairs
+
+    os.makedirs(store_dir, exist_ok=True)
+    geometry_columns = [column for column in find_stereo_pairs.footprint_geometry_columns.values()
+                        if column in footprints]
+    attributes = footprints.drop(columns=geometry_columns)
+    with open(os.path.join(store_dir, 'attributes.pkl'), 'wb') as attributes_file:
+        pickle.dump(attributes, attributes_file)
+
+    stored_projections = []
+    for projection in projections:
+        column = find_stereo_pairs.footprint_geometry_columns[projection]
+        if column not in footprints:
+            continue
+        rows, wkbs, bounds = [], [], []
+        for row, footprint_wkt in enumerate(footprints[column].to_numpy()):
+            if not isinstance(footprint_wkt, str):
+                continue
+            footprint = find_stereo_pairs.polygonize(wkt.loads(footprint_wkt))
+            if footprint is None or footprint.is_empty:
+                continue
+            rows.append(row)
+            wkbs.append(footprint.wkb)
+            bounds.append(footprint.bounds)
+        tree_bounds, tree_levels, tree_items = build_str_tree(numpy.array(bounds, dtype=float).reshape(-1, 4))
+
+        projection_dir = os.path.join(store_dir, projection)
+        os.makedirs(projection_dir, exist_ok=True)
+        arrays = {
+            'wkb': numpy.frombuffer(b''.join(wkbs), dtype=numpy.uint8),
+            'offsets': numpy.concatenate([[0], numpy.cumsum([len(footprint_wkb) for footprint_wkb in wkbs])]),
+            'rows': numpy.array(rows, dtype=int),
+            'tree_bounds': tree_bounds,
+            'tree_levels': tree_levels,
+            'tree_items': tree_items
+        }
+        for name, array in arrays.items():
+            numpy.save(os.path.join(projection_dir, f'{name}.npy'), array)
+        stored_projections.append(projection)
+
+    with open(os.path.join(store_dir, 'store.json'), 'w') as description_file:
+        json.dump({'polygon': polygon, 'projections': stored_projections, 'products': len(attributes)},
+                  description_file)
+
+
+# Arrays stored for each projection, see the module docstring
+array_names = ('wkb', 'offsets', 'rows', 'tree_bounds', 'tree_levels', 'tree_items')
+
+
+def store_files(store_dir: str) -> list:
+    """
+    :return: Paths of every file of a store, e.g. to tell whether it has been rebuilt since results were cached
+    """
+    paths = [os.path.join(store_dir, 'store.json'), os.path.join(store_dir, 'attributes.pkl')]
+    try:
+        with open(paths[0]) as description_file:
+            projections = json.load(description_file)['projections']
+    except (FileNotFoundError, ValueError, KeyError):
+        projections = []
+    for projection in projections:
+        paths += [os.path.join(store_dir, projection, f'{name}.npy') for name in array_names]
+    return paths
+
+
+class FootprintStore:
+    """
+    A footprint store written by build_store, opened for searching.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        :param store_dir: Directory the store was written to
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'store.json')) as description_file:
+            self.description = json.load(description_file)
+        self._attributes = None
+        self._arrays = {}
+
+    @property
+    def attributes(self):
+        """
+        DataFrame of the metadata of every product in the store, loaded on first use
+        """
+        if self._attributes is None:
+            with open(os.path.join(self.store_dir, 'attributes.pkl'), 'rb') as attributes_file:
+                self._attributes = pickle.load(attributes_file)
+        return self._attributes
+
+    def arrays(self, projection: str) -> dict:
+        """
+        :return: dict of the memory mapped arrays of a projection, see the module docstring
+        """
+        import numpy
+        if projection not in self._arrays:
+            if projection not in self.description['projections']:
+                raise ValueError(f'Footprint store {self.store_dir} has no {projection} footprints')
+            projection_dir = os.path.join(self.store_dir, projection)
+            self._arrays[projection] = {
+                name: numpy.load(os.path.join(projection_dir, f'{name}.npy'), mmap_mode='r')
+                for name in array_names
+            }
+        return self._arrays[projection]
+
+    def footprints(self, projection: str, positions) -> list:
+        """
+        :return: list of shapely footprints at positions in a projection's arrays
+        """
+        from nacpl import pair_geometry
+        arrays = self.arrays(projection)
+        wkb, offsets = arrays['wkb'], arrays['offsets']
+        return pair_geometry.from_wkb([bytes(wkb[offsets[position]:offsets[position + 1]]) for position in positions])
+
+    def search(self, polygon: str, projection: str = 'ec'):
+        """
+        Finds the footprints intersecting a search polygon, like an ODE footprint query. The search polygon must lie
+        within the polygon the store was built from, if one was recorded, since the store holds nothing outside it.
+
+        :param polygon: WKT of the search polygon, in longitude, latitude degrees as for ImageSearch
+        :param projection: Projection to search and return footprints in, see find_stereo_pairs.projections
+        :return: GeoDataFrame like ImageSearch.results, with the footprints in footprint_geometry, in the CRS of
+        projection. The WKT footprint columns from ODE are not included.
+        """
+        import geopandas
+        import numpy
+        from shapely import wkt
+        from shapely.prepared import prep
+        from nacpl import find_stereo_pairs
+
+        search_polygon = wkt.loads(polygon)
+        if self.description.get('polygon') and not wkt.loads(self.description['polygon']).covers(search_polygon):
+            raise ValueError(f'Search polygon extends outside the polygon footprint store {self.store_dir} was built '
+                             f'from, so its results would be incomplete. Rebuild the store with a larger polygon, or '
+                             f'search without it.')
+        query = geom_helpers.lonlat_polygon_to_projection(search_polygon, projection)
+        arrays = self.arrays(projection)
+        candidates = numpy.sort(query_str_tree(
+            arrays['tree_bounds'], arrays['tree_levels'], arrays['tree_items'], query.bounds
+        ))
+        footprints = self.footprints(projection, candidates)
+        prepared_query = prep(query)
+        hits = numpy.array([prepared_query.intersects(footprint) for footprint in footprints], dtype=bool)
+        rows = numpy.asarray(arrays['rows'][candidates[hits]])
+        results = geopandas.GeoDataFrame(
+            self.attributes.iloc[rows],
+            geometry=[footprint for footprint, hit in zip(footprints, hits) if hit],
+            crs=find_stereo_pairs.projections[projection]
+        ).rename_geometry('footprint_geometry')
+        return results.dropna()
+
+
+def build(store_dir: str, *, polygon: str, indfilepath: str = None, lblfilepath: str = None, verbose: bool = False):
+    """
+    Builds a footprint store of every NAC intersecting a polygon, e.g. a polar cap, for offline searches with
+    find_stereo_pairs.ImageSearch(polygon=..., store=store_dir)
+
+    :param store_dir: Directory to write the store to
+    :param polygon: WKT of the area to store, in longitude, latitude degrees
+    :param indfilepath: Path of CUMINDEX.TAB. Defaults to find_stereo_pairs.indfilepath
+    :param lblfilepath: Path of INDEX.LBL. Defaults to find_stereo_pairs.lblfilepath
+    :param verbose: Report progress
+    """
+    from nacpl import find_stereo_pairs
+    footprints = find_stereo_pairs.load_footprint_metadata(
+        polygon,
+        indfilepath=indfilepath or find_stereo_pairs.indfilepath,
+        lblfilepath=lblfilepath or find_stereo_pairs.lblfilepath,
+        verbose=verbose
+    )
+    build_store(store_dir, footprints, polygon=polygon)
+    if verbose:
+        print(f'Stored {len(footprints)} NAC footprints in {store_dir}')
+
+
+def main():
+    import clize
+    clize.run(build)
+
+
+if __name__ == '__main__':
+    main()
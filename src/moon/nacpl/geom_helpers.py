@@ -1,18 +1,18 @@
-import numpy as np
-import shapely
-from shapely.geometry import MultiPoint, Polygon, Point
-from shapely.ops import cascaded_union
-from matplotlib import pyplot
-import geopandas
+# shapely, geopandas and matplotlib are imported inside the functions that use them, so that command line steps which
+# only need a few of these helpers don't pay for loading the whole geo and plotting stack at startup.
 from typing import Optional
 
+# Mean radius of the Moon, in meters, as used by the IAU2000:301xx projections in find_stereo_pairs.projections
+moon_radius = 1737400
+
 def corners_to_quadrilateral(west, east, south, north, lonC0=False):
     """
      
     :param lonC0: Boolean. If true, expects -180 to +180 longitudes (centered on 0) and converts them to 0 to 360 
     :return: 
     """
-    
+    from shapely.geometry import Polygon
+
     west, east, south, north = [float(cardinal_dir) for cardinal_dir in (west, east, south, north)]
     try:
         assert -180 < west < east < 180
@@ -35,99 +35,407 @@ def corners_to_quadrilateral(west, east, south, north, lonC0=False):
 def draw_ellipse(center: [float, float],
                  semimajor: float, semiminor: float,
                  rotation: float, save_to: Optional[str] = None):
+    import geopandas
+    from shapely import affinity
+    from shapely.geometry import Point
     circle = Point(center).buffer(1)
-    ellipse = shapely.affinity.scale(circle, semimajor, semiminor)
-    ellipse_rotated = shapely.affinity.rotate(ellipse, rotation)
+    ellipse = affinity.scale(circle, semimajor, semiminor)
+    ellipse_rotated = affinity.rotate(ellipse, rotation)
     gdf = geopandas.GeoDataFrame()
     gdf.geometry = [ellipse_rotated]
     gdf.plot()
     return gdf
 
-def check_if_polys_cover_bb(polys, bb, buffer=0.01):
+def polar_stereographic_to_lonlat(x, y, pole: str, radius: float = moon_radius):
+    """
+    Inverse of the spherical polar stereographic projections in find_stereo_pairs.projections (true scale at the pole).
+
+    :param x: numpy array of x coordinates, in meters
+    :param y: numpy array of y coordinates, in meters
+    :param pole: 'np' for north polar or 'sp' for south polar
+    :return: (lon, lat) numpy arrays, in radians
+    """
+    import numpy
+    rho = numpy.hypot(x, y)
+    colatitude = 2 * numpy.arctan(rho / (2 * radius))
+    if pole == 'np':
+        return numpy.arctan2(x, -y), numpy.pi / 2 - colatitude
+    elif pole == 'sp':
+        return numpy.arctan2(x, y), colatitude - numpy.pi / 2
+    raise ValueError(f'pole should be np or sp, not {pole}')
+
+
+def lonlat_to_polar_stereographic(lon, lat, pole: str, radius: float = moon_radius):
+    """
+    Forward form of polar_stereographic_to_lonlat.
+
+    :param lon: numpy array of longitudes, in radians
+    :param lat: numpy array of latitudes, in radians
+    :param pole: 'np' for north polar or 'sp' for south polar
+    :return: (x, y) numpy arrays, in meters
+    """
+    import numpy
+    if pole == 'np':
+        rho = 2 * radius * numpy.tan((numpy.pi / 2 - lat) / 2)
+        return rho * numpy.sin(lon), -rho * numpy.cos(lon)
+    elif pole == 'sp':
+        rho = 2 * radius * numpy.tan((numpy.pi / 2 + lat) / 2)
+        return rho * numpy.sin(lon), rho * numpy.cos(lon)
+    raise ValueError(f'pole should be np or sp, not {pole}')
+
+
+def lonlat_polygon_to_projection(polygon, projection: str, max_segment: float = 0.1):
+    """
+    Converts a polygon in longitude, latitude degrees, such as a search polygon sent to ODE, to the coordinates of the
+    footprints in projection. Edges are densified first, so that they stay close to their lon / lat course once
+    projected.
+
+    :param polygon: shapely Polygon in degrees
+    :param projection: 'ec' to return polygon unchanged, or 'np' / 'sp'
+    :param max_segment: Longest edge, in degrees, left after densifying
+    :return: shapely Polygon
+    """
+    if projection == 'ec':
+        return polygon
+    import numpy
+    from shapely.geometry import Polygon
+
+    def project_ring(ring):
+        coords = numpy.asarray(ring.coords)
+        steps = numpy.maximum(
+            numpy.ceil(numpy.abs(numpy.diff(coords, axis=0)).max(axis=1) / max_segment).astype(int), 1
+        )
+        dense = numpy.concatenate([
+            start + numpy.outer(numpy.arange(n_steps) / n_steps, stop - start)
+            for start, stop, n_steps in zip(coords[:-1], coords[1:], steps)
+        ] + [coords[-1:]])
+        x, y = lonlat_to_polar_stereographic(numpy.radians(dense[:, 0]), numpy.radians(dense[:, 1]), projection)
+        return numpy.column_stack([x, y])
+
+    return Polygon(project_ring(polygon.exterior), [project_ring(interior) for interior in polygon.interiors])
+
+
+def _ring_coordinates(geometries):
+    """
+    Gathers the coordinates of every ring of every polygon into one array, so that calculations over them can be
+    vectorized.
+
+    :param geometries: Iterable of shapely Polygons or MultiPolygons, or None
+    :return: (coords, ring_ids, ring_geometry, ring_sign, n_geometries) coords is an (n, 2) array of x, y, and ring_ids
+    the ring of each coordinate. ring_geometry holds the position in geometries of each ring, and ring_sign 1 for
+    exteriors and -1 for interiors.
+    """
+    import numpy
+    import shapely
+    geometries = numpy.asarray(geometries, dtype=object).reshape(-1)
+    try:
+        # shapely >= 2 splits the geometries into polygons, rings and coordinates in array operations
+        parts, part_geometry = shapely.get_parts(geometries, return_index=True)
+    except AttributeError:
+        pass
+    else:
+        rings, ring_part = shapely.get_rings(parts, return_index=True)
+        coords, ring_ids = shapely.get_coordinates(rings, return_index=True)
+        # get_rings lists each polygon's exterior first, then its interiors
+        exterior = numpy.ones(len(rings), dtype=bool)
+        exterior[1:] = ring_part[1:] != ring_part[:-1]
+        return coords, ring_ids, part_geometry[ring_part], numpy.where(exterior, 1.0, -1.0), len(geometries)
+
+    coords = []
+    ring_geometry = []
+    ring_sign = []
+    for geometry_index, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        for polygon in getattr(geometry, 'geoms', [geometry]):
+            for sign, ring in [(1, polygon.exterior)] + [(-1, interior) for interior in polygon.interiors]:
+                coords.append(numpy.asarray(ring.coords)[:, :2])
+                ring_geometry.append(geometry_index)
+                ring_sign.append(sign)
+    if not coords:
+        return numpy.empty((0, 2)), numpy.empty(0, dtype=int), numpy.empty(0, dtype=int), numpy.empty(0), \
+            len(geometries)
+    ring_lengths = [len(ring_coords) for ring_coords in coords]
+    ring_ids = numpy.repeat(numpy.arange(len(coords)), ring_lengths)
+    return numpy.concatenate(coords), ring_ids, numpy.array(ring_geometry), numpy.array(ring_sign, dtype=float), \
+        len(geometries)
+
+
+def spherical_area(geometries, projection: str = 'ec', radius: float = moon_radius):
+    """
+    Area of polygons on a sphere, treating polygon edges as great circle arcs. Works on the coordinates directly, so the
+    geometries don't need to be reprojected, and is accurate at any latitude, unlike planar areas in equidistant
+    cylindrical coordinates.
+
+    :param geometries: Iterable of shapely Polygons or MultiPolygons, e.g. the geometry column of a GeoDataFrame. Empty
+    or missing geometries have zero area.
+    :param projection: 'ec' if coordinates are longitude, latitude in degrees, or 'np' / 'sp' for the north / south
+    polar stereographic projections in find_stereo_pairs.projections
+    :param radius: Radius of the sphere, in meters
+    :return: numpy array of areas, in square meters
+
+    >>> from shapely.geometry import Polygon
+    >>> octant = Polygon([(0, 0), (90, 0), (0, 90)])
+    >>> round(float(spherical_area([octant], radius=1)[0] / 3.141592653589793), 6)
+    0.5
+    """
+    import numpy
+
+    coords, ring_ids, ring_geometry, ring_sign, n_geometries = _ring_coordinates(geometries)
+    areas = numpy.zeros(n_geometries)
+    if not len(coords):
+        return areas
+    n_rings = len(ring_sign)
+    if projection == 'ec':
+        lon, lat = numpy.radians(coords[:, 0]), numpy.radians(coords[:, 1])
+    else:
+        lon, lat = polar_stereographic_to_lonlat(coords[:, 0], coords[:, 1], projection, radius)
+
+    # Signed area between each edge and the equator. Rings are closed, so each pair of consecutive vertices belonging
+    # to the same ring is an edge.
+    same_ring = ring_ids[1:] == ring_ids[:-1]
+    dlon = numpy.diff(lon)[same_ring]
+    dlon = (dlon + numpy.pi) % (2 * numpy.pi) - numpy.pi  # Edges crossing the antimeridian take the short way round
+    tan_half_lat = numpy.tan(lat / 2)
+    t1, t2 = tan_half_lat[:-1][same_ring], tan_half_lat[1:][same_ring]
+    excess = 2 * numpy.arctan2(numpy.tan(dlon / 2) * (t1 + t2), 1 + t1 * t2)
+    edge_rings = ring_ids[1:][same_ring]
+    ring_excess = numpy.abs(numpy.bincount(edge_rings, weights=excess, minlength=n_rings))
+    # For a ring enclosing a pole, the sum is the area between the ring and the equator, so subtract from a hemisphere
+    winding = numpy.abs(numpy.bincount(edge_rings, weights=dlon, minlength=n_rings))
+    ring_excess = numpy.where(winding > numpy.pi, 2 * numpy.pi - ring_excess, ring_excess)
+
+    areas += numpy.bincount(ring_geometry, weights=ring_sign * ring_excess, minlength=n_geometries)
+    return areas * radius ** 2
+
+
+def vertex_count(geometry) -> int:
+    """
+    :return: Number of vertices in the rings of a shapely Polygon or MultiPolygon, 0 if it is empty or None
+    """
+    if geometry is None or geometry.is_empty:
+        return 0
+    return sum(
+        len(ring.coords)
+        for polygon in getattr(geometry, 'geoms', [geometry])
+        for ring in [polygon.exterior, *polygon.interiors]
+    )
+
+
+def condition_geometries(geometries, tolerance: float, projection: str = 'ec', grid: float = None,
+                         radius: float = moon_radius):
+    """
+    Reduces the vertices of footprint polygons, to speed up the overlays, intersections and differences done on them.
+    Coordinates are snapped to a grid, which merges near coincident vertices and removes slivers between nearly shared
+    edges, then simplified without changing the topology of each polygon.
+
+    :param geometries: geopandas.GeoSeries of Polygons or MultiPolygons
+    :param tolerance: Largest distance, in meters, any edge may move during simplification
+    :param projection: 'ec' if coordinates are longitude, latitude in degrees, or 'np' / 'sp' for the polar
+    stereographic projections in find_stereo_pairs.projections
+    :param grid: Size, in meters, of the grid coordinates are snapped to. Defaults to a tenth of tolerance.
+    :param radius: Radius of the Moon, in meters
+    :return: (geopandas.GeoSeries, report) The conditioned geometries, with the same index, and a dict with the vertex
+    counts before and after, the fractional vertex reduction, and the largest change of any polygon's area in square
+    meters and as a fraction of its area
+
+    >>> import geopandas
+    >>> from shapely.geometry import Polygon
+    >>> dense_strip = Polygon([(0, y / 100) for y in range(101)] + [(0.1, y / 100) for y in range(100, -1, -1)])
+    >>> conditioned, report = condition_geometries(geopandas.GeoSeries([dense_strip]), tolerance=100)
+    >>> report['vertices_before'], report['vertices_after']
+    (203, 5)
+    >>> report['max_relative_area_error'] < 0.01
+    True
+    """
+    import numpy
+    from shapely import ops
+    if grid is None:
+        grid = tolerance / 10
+    if projection == 'ec':
+        # Convert meters to degrees along a meridian. A degree of longitude is never longer than that, so no edge moves
+        # further than tolerance on the ground.
+        meters_per_unit = radius * numpy.pi / 180
+    else:
+        # The polar stereographic scale factor is at least 1, so projected distances are never shorter than the ground
+        meters_per_unit = 1
+    grid_units = grid / meters_per_unit
+    tolerance_units = tolerance / meters_per_unit
+
+    def snap(x, y, z=None):
+        return numpy.round(numpy.asarray(x) / grid_units) * grid_units, \
+               numpy.round(numpy.asarray(y) / grid_units) * grid_units
+
+    def condition(geometry):
+        if geometry is None or geometry.is_empty:
+            return geometry
+        if grid_units > 0:
+            try:
+                # shapely >= 2 snaps and repairs the geometry in one step
+                import shapely
+                geometry = shapely.set_precision(geometry, grid_units)
+            except AttributeError:
+                geometry = ops.transform(snap, geometry)
+                if not geometry.is_valid:
+                    geometry = geometry.buffer(0)
+        return geometry.simplify(tolerance_units, preserve_topology=True)
+
+    conditioned = geometries.apply(condition)
+    vertices_before = sum(vertex_count(geometry) for geometry in geometries)
+    vertices_after = sum(vertex_count(geometry) for geometry in conditioned)
+    areas_before = spherical_area(geometries, projection=projection, radius=radius)
+    area_errors = numpy.abs(spherical_area(conditioned, projection=projection, radius=radius) - areas_before)
+    relative_errors = numpy.divide(area_errors, areas_before, out=numpy.zeros_like(area_errors),
+                                   where=areas_before > 0)
+    report = {
+        'vertices_before': vertices_before,
+        'vertices_after': vertices_after,
+        'vertex_reduction': 1 - vertices_after / vertices_before if vertices_before else 0.0,
+        'max_area_error_m2': float(area_errors.max()) if len(area_errors) else 0.0,
+        'max_relative_area_error': float(relative_errors.max()) if len(relative_errors) else 0.0
+    }
+    return conditioned, report
+
+
+def check_if_polys_cover_bb(polys, bb, buffer=0.01, resolution=None):
     """
     Check if the set of polygons polys fully covers the bounding box bb.
     :param polys: A geopandas geoseries of polygons
     :param bb: A bounding polygon as a shapely Polygon
+    :param resolution: If given, check coverage on a grid of this cell size using coverage.CoverageGrid, which is much
+    faster than an exact polygon union for large sets of polygons
     :return: boolean indicating whether the bounding box is fully covered
     """
+    if resolution is not None:
+        from nacpl import coverage
+        return coverage.CoverageGrid(bb, resolution).is_covered(polys.buffer(buffer))
+
+    from shapely.ops import unary_union
 
-    polys_union = cascaded_union(polys.buffer(buffer).geometry)
+    polys_union = unary_union(polys.buffer(buffer).geometry)
     return polys_union.contains(bb)
 
 
 def covering_set_search(full_poly_set, search_poly, success_fraction=0.99,
-                        miss_limit=10, rank_by=None, plot=False, verbose=True):
+                        miss_limit=10, rank_by=None, plot=False, verbose=True,
+                        plot_dir=None, plot_every=1, plot_animation=None, coverage_resolution=None,
+                        projection=None):
     """
     Finds a set of polygons taken from full_poly_set which fully cover as much of search_poly as possible.
 
     Replaces find_stereo_pairs.StereoPairSet.find_covering_set and find_polys_from_points
 
-    :param full_poly_set: geopandas.GeoDataFrame whose geometry is a series of shapely polygons
+    :param full_poly_set: geopandas.GeoDataFrame whose active geometry column is a series of shapely polygons
     :param search_poly: shapely.Polygon A polygon to search within
-    :param rank_by: str Column of the full_poly_set to use to prioritse the polygons for inclusion
+    :param rank_by: str Column of the full_poly_set to use to prioritse the polygons for inclusion. Where several
+    polygons contain a search point, the one with the lowest rank_by value is selected. If None, the first one in
+    full_poly_set is selected.
     :param success_fraction: float Fraction of coverage at which to stop searching
     :param miss_limit: int Number of checked locations
-    :param plot: bool Whether to draw a progress figure each step using matplotlib
+    :param plot: bool Whether to draw the progress of the search using matplotlib. Figures are drawn from the search
+    trace in a background process once the search is done; see search_trace.render_trace.
+    :param plot_dir: str Directory to write figures into. Defaults to search_trace.default_output_dir
+    :param plot_every: int Only draw a figure for every nth search step
+    :param plot_animation: str Optional filename for an animated GIF of the search, instead of individual figures
+    :param coverage_resolution: float If given, track coverage on a coverage.CoverageGrid of this cell size instead of
+    by subtracting polygons from search_poly, which is much faster once the uncovered area fragments. Search points are
+    then uncovered cell centers, and a cell which no polygon contains is not tried again.
+    :param projection: str If given, coverage fractions are ratios of spherical_area in this projection rather than of
+    planar areas, which are distorted away from the equator. Ignored if coverage_resolution is given.
     :return: (GeoDataFrame, stats) GeoDataFrame has rows selected from full_poly_set, maintaining all columns. stats
-    contains coverage percent achieved and miss count.
+    contains coverage percent achieved, miss count and the search_trace.CoveringSearchTrace of the search. If
+    coverage_resolution was given, stats also contains the uncovered parts of search_poly as a shapely geometry. If plot
+    was given, stats['render_process'] is the multiprocessing.Process drawing the figures: join() it to wait for them,
+    and check its exitcode for failures.
     """
+    import geopandas
+    import numpy
+    from nacpl import search_trace
+
+    # Positionally indexed, so that spatial index query results can be used directly with iloc
+    polys = geopandas.GeoSeries(full_poly_set.geometry.values)
+    # Priority of each polygon, lower is better
+    if rank_by is None:
+        priority = numpy.arange(len(full_poly_set))
+    else:
+        priority = numpy.empty(len(full_poly_set), dtype=numpy.int64)
+        priority[numpy.argsort(full_poly_set[rank_by].to_numpy(), kind='stable')] = numpy.arange(len(full_poly_set))
 
     coverage_fraction = 0.0
     miss_count = 0
-    selected_polys = geopandas.GeoDataFrame()
-    remaining_uncovered_poly = search_poly #TODO sort by rank_by
+    remaining_uncovered_poly = search_poly
     selected_poly = None
-    search_points = geopandas.GeoDataFrame(columns=['hit', 'geometry'])
-    search_poly_gdf = geopandas.GeoDataFrame({'geometry': [search_poly.boundary]})
+    if projection is not None:
+        search_area = spherical_area([search_poly], projection=projection)[0]
+    trace = search_trace.CoveringSearchTrace()
+    if coverage_resolution is not None:
+        from nacpl import coverage
+        grid = coverage.CoverageGrid(search_poly, coverage_resolution)
+        covered_bits = numpy.zeros_like(grid.aoi_bits)
+        missed_bits = numpy.zeros_like(grid.aoi_bits)
     while coverage_fraction < success_fraction and miss_count < miss_limit:
         # Select a point at a inside search_poly
-        search_point = remaining_uncovered_poly.representative_point()
+        if coverage_resolution is None:
+            search_point = remaining_uncovered_poly.representative_point()
+        else:
+            search_cell = grid.first_cell(grid.aoi_bits & ~covered_bits & ~missed_bits)
+            if search_cell is None:
+                # Every uncovered cell has already been tried
+                break
+            search_point = grid.cell_center(search_cell)
 
         # Maybe move the point a bit
 
-        # Find the first polygon in full_poly_set containing this point and add it to selected_polys
+        # Find the highest priority polygon in full_poly_set containing this point, using the spatial index to avoid
+        # testing every polygon, and add it to selected_polys
         hit = False
-        for ind, poly_row in full_poly_set.iterrows():
-            if poly_row.geometry.contains(search_point):
-                hit = True
-                selected_poly = poly_row.geometry
-                selected_polys = selected_polys.append(poly_row)
+        selected_position = -1
+        containing = numpy.asarray(polys.sindex.query(search_point, predicate='within'))
+        if len(containing):
+            hit = True
+            selected_position = int(containing[numpy.argmin(priority[containing])])
+            selected_poly = polys.iloc[selected_position]
+            if coverage_resolution is None:
                 # Subtract the selected polygon from the remaining_uncovered_poly
                 remaining_uncovered_poly = remaining_uncovered_poly.difference(selected_poly)
                 # Calculate the coverage fraction
-                coverage_fraction = 1 - (remaining_uncovered_poly.area / search_poly.area)
-                if verbose:
-                    print(f'Achieved coverage: {coverage_fraction}, success set to {success_fraction}')
-                break
+                if projection is None:
+                    coverage_fraction = 1 - (remaining_uncovered_poly.area / search_poly.area)
+                else:
+                    coverage_fraction = 1 - (
+                            spherical_area([remaining_uncovered_poly], projection=projection)[0] / search_area)
+            else:
+                covered_bits |= grid.rasterize(selected_poly)
+                coverage_fraction = grid.covered_fraction(covered_bits=covered_bits)
+            if verbose:
+                print(f'Achieved coverage: {coverage_fraction}, success set to {success_fraction}')
 
         # If we got through all of the polygons and none contained the point, increment miss counter
         if hit == False:
             miss_count += 1
+            if coverage_resolution is not None:
+                missed_bits |= grid.cell_bits(search_cell)
             if verbose:
                 print(f'misses: {miss_count} / {miss_limit}')
 
         # Store the search point in case we want to look at the search pattern
-        search_points = search_points.append({'hit': hit, 'search_point': search_point}, ignore_index=True)
-
-        # Maybe plot stuff
-        if plot:
-            from matplotlib import pyplot
-            # Plot the search polygon
-            plotax = search_poly_gdf.boundary.plot()
-
-            # Plot the selected polygons
-            selected_polys['pair_id'] = selected_polys.index #b/c geopandas doesn't accept index in column arg to plot()
-            selected_polys.plot(
-                column='pair_id',
-                legend=True,
-                legend_kwds={'loc': 'center left', 'bbox_to_anchor': (1, 0.5)},
-                ax=plotax
-            )
-            pyplot.savefig(fr'C:\tmp\coversearch\{len(search_points)}')
-            pyplot.close('all')
-            # Plot the search points
-            # TODO
-
-    stats = {'fail_count': miss_count, 'coverage_fraction': coverage_fraction}
-    return selected_polys, stats
+        trace.record(search_point.x, search_point.y, hit, selected_position, coverage_fraction)
 
+    selected_positions = trace.selected_positions()
+    selected_polys = full_poly_set.iloc[selected_positions]
+
+    stats = {'fail_count': miss_count, 'coverage_fraction': coverage_fraction, 'trace': trace}
+    if plot:
+        stats['render_process'] = search_trace.render_trace_in_background(
+            trace,
+            geometries={position: polys.iloc[position] for position in selected_positions},
+            search_poly=search_poly,
+            labels={position: full_poly_set.index[position] for position in selected_positions},
+            output_dir=plot_dir or search_trace.default_output_dir,
+            every=plot_every,
+            animation=plot_animation
+        )
+
+    if coverage_resolution is not None:
+        stats['uncovered'] = grid.uncovered_polygons(covered_bits=covered_bits)
+    return selected_polys, stats
@@ -0,0 +1,106 @@
+"""
+Import time benchmark for the nacpl command line modules.
+
+Every Argo workflow step starts a fresh Python process, so the time spent importing a module is paid once per step.
+The modules below keep their heavy dependencies (the geo stack and matplotlib) behind function level imports; this
+benchmark uses `python -X importtime` to check that stays true and that importing each module stays within budget.
+
+The check runs as a doctest, e.g. `python -m pytest --doctest-modules nacpl/import_benchmark.py`:
+
+>>> check_import_regressions()
+{}
+"""
+
+import os
+import subprocess
+import sys
+
+# Modules run as workflow steps, or imported by them
+cli_modules = (
+    'nacpl.geom_helpers',
+    'nacpl.find_stereo_pairs',
+    'nacpl.find_nacs_mono',
+    'nacpl.mosaic_merge',
+    'nacpl.download_NAC',
+    'nacpl.download_LOLA',
+    'nacpl.footprint_store',
+)
+
+# Packages that must not be loaded just by importing one of the cli_modules
+heavy_modules = ('matplotlib', 'geopandas', 'pandas', 'shapely', 'numpy', 'clize', 'pvl')
+
+# Cumulative import time allowed for each of the cli_modules, in microseconds
+import_budget_us = 100000
+
+# Directory containing the nacpl package, so the modules import from this checkout whatever the working directory
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module: str, python: str = sys.executable) -> dict:
+    """
+    Imports `module` in a new interpreter and returns the cumulative import time of every module it loaded.
+
+    :param module: Dotted name of the module to import, for example nacpl.mosaic_merge
+    :param python: Path of the Python interpreter to use
+    :return: dict of module name to cumulative import time in microseconds
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=package_root, env=env
+    )
+    if proc.returncode != 0:
+        raise ImportError(f'Could not import {module}:\n{proc.stderr}')
+    times = {}
+    # Lines look like "import time:       330 |      49034 | clize", with nested imports indented
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        try:
+            times[name.strip()] = int(cumulative_us)
+        except ValueError:
+            # Header line
+            continue
+    return times
+
+
+def check_import_regressions(modules=cli_modules, forbidden=heavy_modules, budget_us: int = import_budget_us,
+                             runs: int = 3) -> dict:
+    """
+    Checks that none of `modules` pull in `forbidden` packages at import time, and that each imports within budget.
+
+    :param modules: Dotted names of the modules to check
+    :param forbidden: Top level package names which should only be imported lazily
+    :param budget_us: Maximum cumulative import time for each module, in microseconds
+    :param runs: Number of times to import each module. The fastest run is compared against the budget, to reduce noise
+    :return: dict of module name to a list of problems found. Empty if there were no regressions.
+    """
+    problems = {}
+    for module in modules:
+        module_problems = []
+        fastest = None
+        for run in range(runs):
+            times = import_times(module)
+            fastest = times[module] if fastest is None else min(fastest, times[module])
+        loaded_heavy = sorted({name.split('.')[0] for name in times} & set(forbidden))
+        if loaded_heavy:
+            module_problems.append(f'imports {", ".join(loaded_heavy)} at load time')
+        if fastest > budget_us:
+            module_problems.append(f'took {fastest} us to import, budget is {budget_us} us')
+        if module_problems:
+            problems[module] = module_problems
+    return problems
+
+
+def main():
+    problems = check_import_regressions()
+    for module, module_problems in problems.items():
+        for problem in module_problems:
+            print(f'{module} {problem}')
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
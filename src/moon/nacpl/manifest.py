@@ -0,0 +1,132 @@
+"""
+Work manifests for fanning out stereo pairs or images to Argo steps.
+
+By default find_stereo_pairs and find_nacs_mono print a plain list of pairs or product ids, which Argo processes in list
+order. A manifest adds a cost estimate to each item, so that the expensive items can be started first (longest
+processing time first, or LPT, ordering) or the items can be packed into a number of shards with roughly equal total
+cost. Each item keeps its original keys, so templates using {{item.left}} and {{item.right}} keep working.
+
+>>> balanced_shards([5, 4, 3, 3, 3], n_shards=2).tolist()
+[0, 1, 1, 0, 1]
+
+LPT ordering is a stable sort by decreasing cost, and the largest shard is within Graham's bound of 4/3 - 1/(3 n_shards)
+times the best possible, found here by trying every assignment:
+
+>>> costs = numpy.random.RandomState(0).uniform(1, 10, size=9)
+>>> lpt_order(costs).tolist() == sorted(range(9), key=lambda position: -costs[position])
+True
+>>> import itertools
+>>> largest_shard = max(costs[balanced_shards(costs, n_shards=3) == shard].sum() for shard in range(3))
+>>> best = min(max(costs[numpy.array(shard_of) == shard].sum() for shard in range(3))
+...            for shard_of in itertools.product(range(3), repeat=9))
+>>> bool(largest_shard <= (4 / 3 - 1 / 9) * best)
+True
+"""
+
+import heapq
+import numpy
+
+# Samples per line of an LROC NAC EDR, used if the metadata doesn't include line_samples
+nac_line_samples = 5064
+
+# Relative cost of ingesting and map projecting one image pixel, compared to correlating one overlap pixel
+ingest_weight = 0.25
+
+
+def _column(frame, name, default=numpy.nan):
+    if name in frame:
+        return frame[name].to_numpy(dtype=float)
+    return numpy.full(len(frame), default, dtype=float)
+
+
+def pair_costs(pairs):
+    """
+    Estimates the relative cost, in megapixels of work, of processing each stereo pair. Stereo correlation cost scales
+    with the number of overlap pixels at the finer of the two resolutions. Ingest and map projection scale with the
+    size of both images, where image_lines_1/2 are available.
+
+    :param pairs: DataFrame as in StereoPairSet.pairs, with area_m2, resolution_1 and resolution_2 columns
+    :return: numpy array of costs, one per row of pairs
+    """
+    finer_resolution = numpy.fmin(_column(pairs, 'resolution_1'), _column(pairs, 'resolution_2'))
+    costs = _column(pairs, 'area_m2') / finer_resolution ** 2
+    image_pixels = (
+            _column(pairs, 'image_lines_1', 0) * _column(pairs, 'line_samples_1', nac_line_samples) +
+            _column(pairs, 'image_lines_2', 0) * _column(pairs, 'line_samples_2', nac_line_samples)
+    )
+    costs = costs + ingest_weight * image_pixels
+    # Pairs with missing metadata get the median cost rather than sorting to either end
+    costs[~numpy.isfinite(costs)] = numpy.nanmedian(costs) if numpy.isfinite(costs).any() else 1
+    return costs / 1e6
+
+
+def image_costs(images):
+    """
+    Estimates the relative cost, in megapixels, of processing each image of a mono mosaic, from its size.
+
+    :param images: DataFrame as in ImageSearch.results
+    :return: numpy array of costs, one per row of images
+    """
+    costs = _column(images, 'image_lines') * _column(images, 'line_samples', nac_line_samples)
+    costs[~numpy.isfinite(costs)] = numpy.nanmedian(costs) if numpy.isfinite(costs).any() else 1
+    return costs / 1e6
+
+
+def lpt_order(costs):
+    """
+    :return: numpy array of positions ordering costs from most to least expensive. Ties keep their original order.
+    """
+    return numpy.argsort(-numpy.asarray(costs), kind='stable')
+
+
+def balanced_shards(costs, n_shards: int):
+    """
+    Packs items into n_shards shards of roughly equal total cost, by assigning each item, most expensive first, to the
+    shard with the lowest total so far.
+
+    :param costs: Cost of each item
+    :param n_shards: Number of shards, at least 1
+    :return: numpy array with the shard number of each item
+
+    >>> balanced_shards([1, 2], n_shards=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: Number of shards must be at least 1, not 0
+    """
+    if n_shards < 1:
+        raise ValueError(f'Number of shards must be at least 1, not {n_shards}')
+    shard_of = numpy.empty(len(costs), dtype=int)
+    loads = [(0.0, shard) for shard in range(n_shards)]
+    for position in lpt_order(costs):
+        load, shard = heapq.heappop(loads)
+        shard_of[position] = shard
+        heapq.heappush(loads, (load + costs[position], shard))
+    return shard_of
+
+
+def build_manifest(items: list, costs, order: str = 'lpt', shards: int = None) -> list:
+    """
+    Adds costs to work items, and optionally orders and shards them.
+
+    :param items: List of dicts, e.g. {'left': ..., 'right': ...} for a stereo pair
+    :param costs: Cost of each item, e.g. from pair_costs
+    :param order: 'lpt' to put the most expensive items first, or None to keep the order of items
+    :param shards: If given, pack the items into this many shards of roughly equal cost, at least 1
+    :return: List of items with a 'cost' key if shards is None. Otherwise a list of shards, each a dict with the keys
+    'shard', 'cost' (total) and 'items'.
+    """
+    costs = numpy.asarray(costs, dtype=float)
+    positions = lpt_order(costs) if order == 'lpt' else numpy.arange(len(items))
+    costed_items = [{**item, 'cost': round(float(cost), 3)} for item, cost in zip(items, costs)]
+    if shards is None:
+        return [costed_items[position] for position in positions]
+
+    shard_of = balanced_shards(costs, shards)
+    return [
+        {
+            'shard': shard,
+            'cost': round(float(costs[shard_of == shard].sum()), 3),
+            'items': [costed_items[position] for position in positions if shard_of[position] == shard]
+        }
+        for shard in range(shards)
+    ]
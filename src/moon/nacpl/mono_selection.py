@@ -0,0 +1,120 @@
+"""
+Selects NAC images for mono (non-stereo) mosaics.
+
+Polar searches can return thousands of overlapping NACs, so the selection works on a compact frame holding only the
+shrunk footprints and a score for each image, and relies on the spatial index in geom_helpers.covering_set_search to
+find the images under each search point. Where several images could cover a point, the best scoring one is chosen.
+"""
+
+from nacpl import geom_helpers
+
+# Relative importance of each term in score_images. Set a weight to 0 to ignore that term.
+default_weights = {'incidence': 1.0, 'resolution': 1.0, 'recency': 0.5}
+
+
+def shrink_footprints(footprints, factor: float = 0.9):
+    """
+    Scales every footprint about the center of its bounding box, so that neighbouring images chosen to cover an area
+    still overlap a little, which the mosaicking steps need.
+
+    >>> import geopandas
+    >>> from shapely.geometry import box
+    >>> shrink_footprints(geopandas.GeoSeries([box(0, 0, 2, 2), box(10, 0, 14, 1)]), 0.5).bounds.values.tolist()
+    [[0.5, 0.5, 1.5, 1.5], [11.0, 0.25, 13.0, 0.75]]
+
+    :param footprints: geopandas.GeoSeries of footprint polygons
+    :param factor: Scale factor, less than 1 to shrink
+    :return: geopandas.GeoSeries of scaled footprints, with the same index
+    """
+    import geopandas
+    import numpy
+    import shapely
+    geometries = numpy.asarray(footprints.values, dtype=object)
+    try:
+        # shapely >= 2 scales every coordinate of every footprint in one array operation
+        bounds = shapely.bounds(geometries)
+        counts = shapely.get_num_coordinates(geometries)
+    except AttributeError:
+        return footprints.scale(factor, factor, factor, origin='center')
+    centers = numpy.repeat((bounds[:, :2] + bounds[:, 2:]) / 2, counts, axis=0)
+    scaled = shapely.transform(geometries, lambda coords: centers + (coords - centers) * factor)
+    return geopandas.GeoSeries(scaled, index=footprints.index, crs=footprints.crs)
+
+
+def score_images(images, ideal_incidence: float = 50, weights: dict = None):
+    """
+    Scores images for inclusion in a mono mosaic. Lower scores are better. Each term is scaled to roughly 0 to 1 before
+    weighting:
+
+        incidence: distance of incidence_angle from ideal_incidence, as a fraction of 90 degrees
+        resolution: resolution relative to the coarsest image in the set
+        recency: age of the image relative to the oldest and newest in the set
+
+    Terms whose column is missing from images are skipped.
+
+    :param images: DataFrame of NAC metadata as in ImageSearch.results
+    :param ideal_incidence: Solar incidence angle, in degrees, which gives the best looking mosaic
+    :param weights: dict of term name to weight. Defaults to default_weights.
+    :return: pandas.Series of scores with the same index as images
+    """
+    import numpy
+    import pandas
+    weights = {**default_weights, **(weights or {})}
+    score = pandas.Series(numpy.zeros(len(images)), index=images.index)
+
+    if weights['incidence'] and 'incidence_angle' in images:
+        score += weights['incidence'] * (images.incidence_angle - ideal_incidence).abs() / 90
+
+    if weights['resolution'] and 'resolution' in images:
+        coarsest = images.resolution.max()
+        if coarsest > 0:
+            score += weights['resolution'] * images.resolution / coarsest
+
+    if weights['recency'] and 'start_time' in images:
+        start_time = pandas.to_datetime(images.start_time)
+        span = start_time.max() - start_time.min()
+        if span > pandas.Timedelta(0):
+            score += weights['recency'] * (start_time.max() - start_time) / span
+
+    return score
+
+
+def select_mono_images(images, search_poly, exclude=(), shrink: float = 0.9, ideal_incidence: float = 50,
+                       weights: dict = None, success_fraction: float = 0.99, miss_limit: int = 10,
+                       plot: bool = False, verbose: bool = False):
+    """
+    Chooses a set of images that together cover search_poly, preferring the best scoring images.
+
+    :param images: GeoDataFrame of NAC metadata and footprints as in ImageSearch.results
+    :param search_poly: shapely Polygon to cover
+    :param exclude: Product ids which must not be selected
+    :param shrink: Scale factor applied to footprints before searching, see shrink_footprints
+    :param ideal_incidence: See score_images
+    :param weights: See score_images
+    :param success_fraction: See geom_helpers.covering_set_search
+    :param miss_limit: See geom_helpers.covering_set_search
+    :param plot: See geom_helpers.covering_set_search
+    :param verbose: See geom_helpers.covering_set_search
+    :return: (GeoDataFrame, stats) GeoDataFrame has the selected rows of images, in order of selection. stats is as
+    returned by geom_helpers.covering_set_search
+    """
+    import geopandas
+    images = images.loc[~images.index.isin(list(exclude))]
+    # Only carry the columns the search needs, so selecting rows during the search is cheap
+    candidates = geopandas.GeoDataFrame(
+        {
+            'mono_score': score_images(images, ideal_incidence=ideal_incidence, weights=weights),
+            'geometry': shrink_footprints(images.geometry, shrink)
+        },
+        geometry='geometry'
+    )
+    selected, stats = geom_helpers.covering_set_search(
+        full_poly_set=candidates,
+        search_poly=search_poly,
+        success_fraction=success_fraction,
+        miss_limit=miss_limit,
+        rank_by='mono_score',
+        plot=plot,
+        verbose=verbose
+    )
+    return images.loc[selected.index], stats
@@ -4,8 +4,8 @@ Ames Stereo Pipeline dem_merge expects
 """
 
 import subprocess
-from clize import run
 import json
+import os
 from os import path
 from glob import glob
 
@@ -22,7 +22,284 @@ def mosaic_name(pairs_param):
     )[:-1]
 
 
-def mosaic_merge(pairs_param, output_type, data_dir, output_dir):
+def tree_mosaic_name(pairs_param):
+    """
+    Generates a bounded length filename for a tree mode mosaic, which may combine hundreds of pairs, from a hash of the
+    sorted pair names.
+    """
+    import hashlib
+    pair_names = sorted(f'{pair["left"]}xx{pair["right"]}' for pair in pairs_param)
+    return 'mosaic-' + hashlib.sha1('\n'.join(pair_names).encode()).hexdigest()[:16]
+
+
+def mosaic_path(output_prefix, output_type):
+    """
+    Path of the mosaic written by mosaic_merge. dem_mosaic appends -tile-0.tif to the prefix it's given.
+    """
+    if output_type == 'DEM':
+        return f'{output_prefix}-tile-0.tif'
+    return f'{output_prefix}-median-{output_type}.tif'
+
+
+def mosaic_command(inputs, output_type, output):
+    """
+    Command line to mosaic inputs with dem_mosaic (DEM) or otbcli_Mosaic (DRG).
+
+    :param inputs: Paths of the rasters to mosaic
+    :param output_type: DEM or DRG
+    :param output: For DEM, an output prefix or an exact output path ending in .tif. For DRG, the output path.
+    :return: list of arguments for subprocess.run
+    """
+    if output_type == 'DEM':
+        return ['dem_mosaic'] + inputs + ['-o', output]
+    elif output_type == 'DRG':
+        return (
+            ['otbcli_Mosaic', '-il'] +
+            inputs +
+            ['-comp.feather', 'slim', '-comp.feather.slim.exponent', '1', '-comp.feather.slim.length', '0.1'] +
+            ['-harmo.method', 'band', '-harmo.cost', 'rmse'] +
+            ['-nodata', '-9999', '-out', output]
+        )
+    raise ValueError(f'output_type should be DEM or DRG, not {output_type}')
+
+
+def raster_bounds(raster_path):
+    """
+    :return: (minx, miny, maxx, maxy) of a raster in its own coordinates, read with gdalinfo
+    """
+    info = subprocess.run(['gdalinfo', '-json', raster_path], stdout=subprocess.PIPE, check=True)
+    corners = json.loads(info.stdout)['cornerCoordinates']
+    xs = [corner[0] for corner in corners.values()]
+    ys = [corner[1] for corner in corners.values()]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def group_adjacent(bounds, batch_size):
+    """
+    Groups rasters into batches of at most batch_size spatially adjacent rasters, using Sort-Tile-Recursive packing:
+    sort by x into vertical slabs, then by y within each slab.
+
+    :param bounds: List of (minx, miny, maxx, maxy), one per raster
+    :param batch_size: Maximum rasters per batch
+    :return: List of batches, each a list of positions in bounds
+    """
+    import math
+    centers = [((minx + maxx) / 2, (miny + maxy) / 2) for minx, miny, maxx, maxy in bounds]
+    n_batches = math.ceil(len(bounds) / batch_size)
+    slab_size = batch_size * math.ceil(math.sqrt(n_batches))
+    by_x = sorted(range(len(bounds)), key=lambda i: centers[i])
+    batches = []
+    for slab_start in range(0, len(by_x), slab_size):
+        slab = sorted(by_x[slab_start:slab_start + slab_size], key=lambda i: (centers[i][1], centers[i][0]))
+        batches += [slab[start:start + batch_size] for start in range(0, len(slab), batch_size)]
+    return batches
+
+
+def _merge_batch(inputs, output_type, output_path):
+    """
+    Mosaics inputs into output_path, unless a previous run already did. Writes to a temporary file first, so an
+    interrupted merge never leaves a partial output that would be mistaken for a finished one.
+    """
+    if path.exists(output_path):
+        print(f'Reusing {output_path}')
+        return output_path
+    tmp_path = output_path[:-len('.tif')] + '-partial.tif'
+    args = mosaic_command(inputs, output_type, tmp_path)
+    print(f'running {" ".join(args)}')
+    subprocess.run(args, check=True)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def merge_tree(inputs, output_type, output_path, work_dir, batch_size=8, workers=None):
+    """
+    Mosaics many rasters as a tree of small merges rather than one large one, to stay within command line length and
+    memory limits and to use several processes. Spatially adjacent inputs are mosaicked in batches in parallel, then
+    the batch mosaics are merged the same way, level by level, until one mosaic remains.
+
+    Intermediate mosaics are kept in work_dir, named by a hash of their inputs, so rerunning after a failure only redoes
+    the merges that didn't finish. DRG batches use the same feathering and harmonization as a single otbcli_Mosaic,
+    although radiometric harmonization is then done per batch rather than across all inputs at once.
+
+    :param inputs: Paths of the rasters to mosaic
+    :param output_type: DEM or DRG
+    :param output_path: Path of the final mosaic, ending in .tif
+    :param work_dir: Directory for intermediate mosaics
+    :param batch_size: Maximum number of rasters merged by one command, at least 2
+    :param workers: Maximum number of merges to run at once. Defaults to the number of CPUs.
+    :return: output_path
+    """
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    if batch_size < 2:
+        raise ValueError(f'batch_size must be at least 2, not {batch_size}')
+    if not inputs:
+        raise ValueError('No rasters to mosaic')
+    os.makedirs(work_dir, exist_ok=True)
+    bounds = [raster_bounds(raster) for raster in inputs]
+    level = 0
+    # The mosaicking tools do the work in their own processes, so threads are enough to run them in parallel
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        while len(inputs) > batch_size:
+            level += 1
+            batches = group_adjacent(bounds, batch_size)
+            futures = []
+            for batch in batches:
+                batch_inputs = [inputs[i] for i in batch]
+                if len(batch_inputs) == 1:
+                    futures.append(None)
+                    continue
+                batch_hash = hashlib.sha1('\n'.join(sorted(batch_inputs)).encode()).hexdigest()[:12]
+                batch_output = path.join(work_dir, f'L{level}-{batch_hash}-{output_type}.tif')
+                futures.append(executor.submit(_merge_batch, batch_inputs, output_type, batch_output))
+            inputs = [
+                inputs[batch[0]] if future is None else future.result()
+                for batch, future in zip(batches, futures)
+            ]
+            bounds = [
+                (min(bounds[i][0] for i in batch), min(bounds[i][1] for i in batch),
+                 max(bounds[i][2] for i in batch), max(bounds[i][3] for i in batch))
+                for batch in batches
+            ]
+    return _merge_batch(inputs, output_type, output_path)
+
+
+# Nodata value of quantized DEMs. It is the lowest int16, and a power of two, so float16 stores it exactly, and it is far
+# below any lunar elevation.
+quantized_nodata = -32768
+
+
+def raster_stats(raster_path):
+    """
+    :return: (minimum, maximum, nodata) of the first band of a raster, read by gdalinfo. The minimum and maximum ignore
+    nodata pixels, and nodata is None if the band has no nodata value.
+    """
+    info = subprocess.run(['gdalinfo', '-json', '-mm', raster_path], stdout=subprocess.PIPE, check=True)
+    band = json.loads(info.stdout)['bands'][0]
+    return band['computedMin'], band['computedMax'], band.get('noDataValue')
+
+
+def driver_creation_options(driver):
+    """
+    :return: set of the names of the creation options a GDAL driver supports, read from gdalinfo --format
+    """
+    import re
+    info = subprocess.run(['gdalinfo', '--format', driver], stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return set(re.findall(r"<Option name='([^']+)'", info.stdout))
+
+
+def check_quantize(quantize):
+    """
+    Raises ValueError unless quantize is a quantization the installed GDAL can write
+    """
+    if quantize not in ('int16', 'float16'):
+        raise ValueError(f'quantize should be int16 or float16, not {quantize}')
+    if quantize == 'float16' and 'NBITS' not in driver_creation_options('COG'):
+        raise ValueError('The installed GDAL COG driver has no NBITS creation option, so it cannot write float16. '
+                         'Use int16 instead.')
+
+
+def quantization_args(minimum, maximum, quantize, vertical_precision):
+    """
+    gdal_translate arguments to store a DEM at reduced precision.
+
+    int16 stores round((elevation - offset) / vertical_precision) with the scale and offset recorded in the file, so
+    readers which apply them (GDAL, rasterio with masked scaling) get elevations back to within vertical_precision / 2.
+    float16 stores half precision floats (GDAL's NBITS=16 on a Float32 band). Their precision is relative, so the stated
+    vertical precision is half the spacing of float16 values at the largest absolute elevation in the DEM. Only GDAL
+    versions whose COG driver has the NBITS creation option can write them, see check_quantize.
+
+    Nodata pixels must be set to the returned fill value before these arguments are applied, which quantizes them to
+    quantized_nodata. Below, a nodata pixel and an elevation go through the arithmetic of gdal_translate -scale:
+
+    >>> args, precision, fill, nodata = quantization_args(-5000.0, 3000.0, 'int16', 0.5)
+    >>> src_min, src_max, dst_min, dst_max = map(float, args[args.index('-scale') + 1:args.index('-scale') + 5])
+    >>> def to_int16(value):
+    ...     return round(dst_min + (value - src_min) * (dst_max - dst_min) / (src_max - src_min))
+    >>> to_int16(fill) == nodata == quantized_nodata
+    True
+    >>> scale, offset = float(args[args.index('-a_scale') + 1]), float(args[args.index('-a_offset') + 1])
+    >>> abs(to_int16(1234.3) * scale + offset - 1234.3) <= precision
+    True
+    >>> import numpy
+    >>> args, precision, fill, nodata = quantization_args(-5000.0, 3000.0, 'float16', 0.5)
+    >>> float(numpy.float16(fill)) == fill == nodata == quantized_nodata
+    True
+
+    :param minimum: Lowest elevation in the DEM, ignoring nodata
+    :param maximum: Highest elevation in the DEM, ignoring nodata
+    :param quantize: 'int16' or 'float16'
+    :param vertical_precision: For int16, the elevation step in meters
+    :return: (list of arguments, stated vertical precision in meters, fill value for nodata pixels, nodata value)
+    """
+    import math
+    if quantize == 'int16':
+        # quantized_nodata is kept for nodata
+        if (maximum - minimum) / vertical_precision > 65533:
+            raise ValueError(f'Elevation range {minimum} to {maximum} m is too large to store as int16 with '
+                             f'{vertical_precision} m precision')
+        offset = round((minimum + maximum) / 2 / vertical_precision) * vertical_precision
+        args = ['-ot', 'Int16',
+                '-scale', str(minimum), str(maximum),
+                str((minimum - offset) / vertical_precision), str((maximum - offset) / vertical_precision),
+                '-a_scale', str(vertical_precision), '-a_offset', str(offset)]
+        # The elevation that scales to quantized_nodata
+        fill = offset + quantized_nodata * vertical_precision
+        return args, vertical_precision / 2, fill, quantized_nodata
+    if quantize == 'float16':
+        largest = max(abs(minimum), abs(maximum))
+        # float16 has a 10 bit mantissa, so values are spaced 2**(exponent - 10) apart
+        spacing = 2 ** (math.floor(math.log2(largest)) - 10) if largest > 0 else 2 ** -24
+        return ['-ot', 'Float32', '-co', 'NBITS=16'], spacing / 2, quantized_nodata, quantized_nodata
+    raise ValueError(f'quantize should be int16 or float16, not {quantize}')
+
+
+def to_cog(source_path, cog_path, quantize=None, vertical_precision=0.5, blocksize=512):
+    """
+    Converts a mosaic to a cloud optimized GeoTIFF (COG): tiled, DEFLATE compressed using all CPUs, with internal
+    overviews, so that tile servers and windowed reads only touch the bytes they need. The source's nodata value is
+    kept, or, when quantizing, its nodata pixels are rewritten to quantized_nodata, so that overviews never average
+    them into valid elevations.
+
+    :param source_path: Mosaic to convert
+    :param cog_path: Where to write the COG
+    :param quantize: None to keep the source data type, or 'int16' / 'float16' to reduce the precision of a DEM. See
+    quantization_args
+    :param vertical_precision: For int16 quantization, the elevation step in meters
+    :param blocksize: Tile size in pixels
+    """
+    args = ['gdal_translate', '-of', 'COG',
+            '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=YES', '-co', 'NUM_THREADS=ALL_CPUS',
+            '-co', f'BLOCKSIZE={blocksize}', '-co', 'OVERVIEWS=AUTO', '-co', 'RESAMPLING=AVERAGE',
+            '--config', 'GDAL_NUM_THREADS', 'ALL_CPUS']
+    input_path = source_path
+    if quantize:
+        check_quantize(quantize)
+        minimum, maximum, source_nodata = raster_stats(source_path)
+        quantize_args, stated_precision, fill, nodata = quantization_args(minimum, maximum, quantize,
+                                                                          vertical_precision)
+        if source_nodata is not None:
+            # Replace the source's nodata, e.g. -3.4e38 from point2dem and dem_mosaic, with the value that quantizes to
+            # nodata. Warping to the source's own grid only rewrites those pixels.
+            input_path = f'{cog_path}.nodata.vrt'
+            warp_args = ['gdalwarp', '-overwrite', '-of', 'VRT', '-ot', 'Float32',
+                         '-srcnodata', repr(float(source_nodata)), '-dstnodata', repr(float(fill)),
+                         path.abspath(source_path), input_path]
+            print(f'running {" ".join(warp_args)}')
+            subprocess.run(warp_args, check=True)
+        args += quantize_args + ['-a_nodata', str(nodata), '-mo', f'VERTICAL_PRECISION={stated_precision}']
+        print(f'Storing {source_path} as {quantize}, vertical precision {stated_precision} m')
+    args += [input_path, cog_path]
+    print(f'running {" ".join(args)}')
+    try:
+        subprocess.run(args, check=True)
+    finally:
+        if input_path != source_path:
+            os.remove(input_path)
+
+
+def mosaic_merge(pairs_param, output_type, data_dir, output_dir, *, cog: bool = False, quantize: str = None,
+                 vertical_precision: float = 0.5, tree: bool = False, batch_size: int = 8, workers: int = None):
     """
     Merge stereo pair output into a DEM mosaic (using ASP's dem_mosaic) or orthomosaic (using Orfeo Toolbox's Mosaic).
 
@@ -30,35 +307,60 @@ def mosaic_merge(pairs_param, output_type, data_dir, output_dir):
     :param output_type:
     :param data_dir: Where to look for source images
     :param output_dir: Where to output the mosaic
+    :param cog: Also write the mosaic as a cloud optimized GeoTIFF with overviews, next to the mosaic with -cog.tif
+    replacing .tif. See to_cog
+    :param quantize: With cog, store a DEM as int16 or float16 instead of float32
+    :param vertical_precision: With quantize=int16, the elevation step in meters
+    :param tree: Mosaic as a tree of parallel merges of adjacent inputs, for large numbers of pairs. See merge_tree. The
+    mosaic is then named by a hash of the pairs, see tree_mosaic_name
+    :param batch_size: With tree, the maximum number of rasters merged by one command, at least 2
+    :param workers: With tree, the maximum number of merges to run at once
     :return:
     """
     output_type = output_type.upper()
+    if tree and batch_size < 2:
+        raise ValueError(f'batch_size must be at least 2, not {batch_size}')
+    if cog and quantize and output_type == 'DEM':
+        # Fail before merging rather than after
+        check_quantize(quantize)
     pairs_param = json.loads(pairs_param)
-    output_prefix = f'{output_dir}/{mosaic_name(pairs_param)}'
+    # mosaic_name grows with the number of pairs, and would exceed the file name length limit for large trees
+    name = tree_mosaic_name(pairs_param) if tree else mosaic_name(pairs_param)
+    output_prefix = f'{output_dir}/{name}'
     existing_file = glob(f'{output_prefix}*{output_type}.tif')
     print(f'Looking for {output_prefix}*{output_type}.tif')
     if not existing_file:
         pairs = [f'{data_dir}/{pair["left"]}xx{pair["right"]}-median-{output_type}.tif' for pair in pairs_param]
         pairs = [pair for pair in pairs if path.exists(pair)]
-        if output_type == 'DEM':
-            args = ['dem_mosaic'] + pairs + ['-o', output_prefix]
-            args_str = ' '.join(args)
-            print(f'running dem_mosaic {args_str}')
-            subprocess.run(['dem_mosaic'] + pairs + ['-o', output_prefix])
-        elif output_type == 'DRG':
-            args = ['otbcli_Mosaic', '-il'] + pairs + ['-out', output_prefix + '-median-DRG.tif']
-            args_str = ' '.join(args)
-            print(f'running otbcli_Mosaic {args_str}')
-            subprocess.run(
-                ['otbcli_Mosaic', '-il'] +
-                pairs +
-                ['-comp.feather', 'slim', '-comp.feather.slim.exponent', '1', '-comp.feather.slim.length', '0.1'] +
-                ['-harmo.method', 'band', '-harmo.cost', 'rmse'] +
-                ['-nodata', '-9999', '-out', output_prefix + '-median-DRG.tif']
-            )
+        if not pairs:
+            print(f'No {output_type} pair outputs found in {data_dir}, nothing to mosaic')
+            return
+        if tree:
+            merge_tree(pairs, output_type, mosaic_path(output_prefix, output_type),
+                       work_dir=f'{output_prefix}-mergetree', batch_size=batch_size, workers=workers)
+        else:
+            # dem_mosaic is given a prefix rather than a .tif path, and writes {output_prefix}-tile-0.tif
+            output = output_prefix if output_type == 'DEM' else mosaic_path(output_prefix, output_type)
+            args = mosaic_command(pairs, output_type, output)
+            print(f'running {" ".join(args)}')
+            subprocess.run(args)
     else:
         print(f'Skipping mosaic generation because {existing_file[0]} already exists')
 
+    if cog:
+        source_path = mosaic_path(output_prefix, output_type)
+        cog_path = source_path[:-len('.tif')] + '-cog.tif'
+        if path.exists(cog_path):
+            print(f'Skipping COG generation because {cog_path} already exists')
+        elif path.exists(source_path):
+            to_cog(source_path, cog_path, quantize=quantize if output_type == 'DEM' else None,
+                   vertical_precision=vertical_precision)
 
-if __name__ == '__main__':
+
+def main():
+    from clize import run
     run(mosaic_merge)
+
+
+if __name__ == '__main__':
+    main()
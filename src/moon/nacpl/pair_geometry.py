@@ -0,0 +1,280 @@
+"""
+Builds the overlap geometry of every pair of overlapping footprints, for StereoPairSet.
+
+Candidate pairs are found by comparing bounding boxes with numpy, a block of rows at a time, optionally together with
+pair quality thresholds (see pair_quality), and only candidates are intersected with shapely. For large (e.g. polar)
+searches the work can be spread over processes: the footprints are divided into spatial shards, each footprint going to
+every shard its bounding box touches, and each shard computes the pairs it owns. A pair is owned by the shard containing
+the lower left corner of the intersection of the two bounding boxes, so every pair is computed exactly once. The
+footprints reach the worker processes as one buffer of WKB inherited when the pool forks, rather than as pickled frames,
+and the results come back as WKB.
+
+Pairs are always oriented so that prod_id_1 < prod_id_2, and come out in the same order whether built serially or in
+parallel.
+
+>>> import numpy
+>>> bounds = numpy.array([[0, 0, 2, 2], [1, 1, 3, 3], [5, 5, 6, 6], [2, 0, 4, 1]], dtype=float)
+>>> left, right = candidate_pairs(bounds, block_size=2)
+>>> list(zip(left.tolist(), right.tolist()))
+[(0, 1), (0, 3), (1, 3)]
+"""
+
+import numpy
+
+# Footprints are shared with worker processes through this, set just before the pool forks
+_worker_state = {}
+
+
+def from_wkb(wkbs) -> list:
+    """
+    :return: list of shapely geometries from a sequence of WKB bytes, vectorized where shapely >= 2 is available
+    """
+    try:
+        import shapely
+        return list(shapely.from_wkb(wkbs))
+    except AttributeError:
+        from shapely import wkb
+        return [wkb.loads(bytes(geometry_wkb)) for geometry_wkb in wkbs]
+
+
+def _to_wkb(geometries) -> list:
+    return [geometry.wkb for geometry in geometries]
+
+
+def _intersection(left_geometries, right_geometries) -> list:
+    """
+    :return: Pairwise intersections, vectorized where shapely >= 2 is available
+    """
+    try:
+        import shapely
+        return list(shapely.intersection(numpy.asarray(left_geometries, dtype=object),
+                                         numpy.asarray(right_geometries, dtype=object)))
+    except AttributeError:
+        return [left.intersection(right) for left, right in zip(left_geometries, right_geometries)]
+
+
+def _polygonal_part(geometry):
+    """
+    :return: The Polygon or MultiPolygon part of an intersection, or None if it has no area, like geopandas.overlay with
+    keep_geom_type=True
+    """
+    if geometry is None or geometry.is_empty:
+        return None
+    if geometry.geom_type in ('Polygon', 'MultiPolygon'):
+        return geometry
+    if geometry.geom_type == 'GeometryCollection':
+        from shapely.geometry import MultiPolygon
+        polygons = [
+            polygon
+            for part in geometry.geoms if part.geom_type in ('Polygon', 'MultiPolygon')
+            for polygon in getattr(part, 'geoms', [part])
+        ]
+        if len(polygons) == 1:
+            return polygons[0]
+        if polygons:
+            return MultiPolygon(polygons)
+    return None
+
+
+def candidate_pairs(bounds, block_size: int = 1024, pair_mask=None):
+    """
+    Finds the pairs of footprints whose bounding boxes intersect.
+
+    :param bounds: numpy array of (minx, miny, maxx, maxy) rows, one per footprint
+    :param block_size: Rows compared at once. Memory use is about block_size * len(bounds) bytes.
+    :param pair_mask: Optional function called as pair_mask(rows, columns), with numpy arrays of positions in bounds,
+    returning a boolean array shaped (len(rows), len(columns)) which is False for pairs to leave out, e.g.
+    pair_quality.QualityMatrix.block
+    :return: (left, right) numpy arrays of positions in bounds, with left < right, sorted by left then right
+    """
+    bounds = numpy.asarray(bounds, dtype=float)
+    lefts, rights = [], []
+    for start in range(0, len(bounds), block_size):
+        block = bounds[start:start + block_size]
+        # Only positions from start onwards can be right of a pair in this block
+        others = bounds[start:]
+        overlap = (
+                (block[:, None, 0] <= others[None, :, 2]) & (others[None, :, 0] <= block[:, None, 2]) &
+                (block[:, None, 1] <= others[None, :, 3]) & (others[None, :, 1] <= block[:, None, 3])
+        )
+        if pair_mask is not None:
+            overlap &= pair_mask(numpy.arange(start, start + len(block)), numpy.arange(start, len(bounds)))
+        left, right = numpy.nonzero(overlap)
+        keep = left < right
+        lefts.append(left[keep] + start)
+        rights.append(right[keep] + start)
+    if not lefts:
+        return numpy.empty(0, dtype=int), numpy.empty(0, dtype=int)
+    return numpy.concatenate(lefts), numpy.concatenate(rights)
+
+
+def shard_regions(bounds, n_shards: int, method: str = 'grid'):
+    """
+    Divides the plane into regions for sharding footprints. The regions are half open rectangles, [minx, maxx) by
+    [miny, maxy), and the outer ones extend to infinity, so that every point is in exactly one region.
+
+    :param bounds: numpy array of footprint (minx, miny, maxx, maxy) rows
+    :param n_shards: Number of regions wanted. 'str' may return a few fewer.
+    :param method: 'grid' for equal sized cells over the footprints' extent, or 'str' for Sort-Tile-Recursive
+    partitioning of the footprint centers, which gives each region about the same number of footprints
+    :return: numpy array of (minx, miny, maxx, maxy) region rows
+    """
+    bounds = numpy.asarray(bounds, dtype=float)
+    n_columns = int(numpy.ceil(numpy.sqrt(n_shards)))
+    n_rows = int(numpy.ceil(n_shards / n_columns))
+
+    def edges(splits):
+        return numpy.concatenate([[-numpy.inf], splits, [numpy.inf]])
+
+    if method == 'grid':
+        x_edges = edges(numpy.linspace(bounds[:, 0].min(), bounds[:, 2].max(), n_columns + 1)[1:-1])
+        y_edges = edges(numpy.linspace(bounds[:, 1].min(), bounds[:, 3].max(), n_rows + 1)[1:-1])
+        return numpy.array([
+            (x_edges[column], y_edges[row], x_edges[column + 1], y_edges[row + 1])
+            for column in range(n_columns) for row in range(n_rows)
+        ])
+    elif method == 'str':
+        center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+        center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+        x_edges = edges(numpy.unique(numpy.quantile(center_x, numpy.linspace(0, 1, n_columns + 1)[1:-1])))
+        regions = []
+        for column in range(len(x_edges) - 1):
+            in_slice = (center_x >= x_edges[column]) & (center_x < x_edges[column + 1])
+            slice_y = center_y[in_slice] if in_slice.any() else center_y
+            y_edges = edges(numpy.unique(numpy.quantile(slice_y, numpy.linspace(0, 1, n_rows + 1)[1:-1])))
+            regions.extend(
+                (x_edges[column], y_edges[row], x_edges[column + 1], y_edges[row + 1]) for row in range(len(y_edges) - 1)
+            )
+        return numpy.array(regions)
+    raise ValueError(f'method should be grid or str, not {method}')
+
+
+def _owned(bounds, left, right, region) -> 'numpy.ndarray':
+    """
+    :return: Boolean array, True for the candidate pairs owned by region
+    """
+    corner_x = numpy.maximum(bounds[left, 0], bounds[right, 0])
+    corner_y = numpy.maximum(bounds[left, 1], bounds[right, 1])
+    return (
+            (corner_x >= region[0]) & (corner_x < region[2]) &
+            (corner_y >= region[1]) & (corner_y < region[3])
+    )
+
+
+def _intersect_candidates(geometries, left, right):
+    """
+    :return: (left, right, geometries) of the candidate pairs whose intersection has an area
+    """
+    intersections = [_polygonal_part(geometry) for geometry in _intersection(
+        [geometries[position] for position in left], [geometries[position] for position in right]
+    )]
+    keep = numpy.array([geometry is not None for geometry in intersections], dtype=bool)
+    return left[keep], right[keep], [geometry for geometry in intersections if geometry is not None]
+
+
+def _shard_pairs(shard: int):
+    """
+    Computes the pairs owned by one shard. Runs in a worker process, reading the footprints from _worker_state.
+
+    :return: (left, right, list of WKB) of the shard's pairs, with positions in the full set of footprints
+    """
+    bounds = _worker_state['bounds']
+    region = _worker_state['regions'][shard]
+    members = numpy.flatnonzero(
+        (bounds[:, 0] < region[2]) & (bounds[:, 2] >= region[0]) &
+        (bounds[:, 1] < region[3]) & (bounds[:, 3] >= region[1])
+    )
+    pair_mask = _worker_state['pair_mask']
+    left, right = candidate_pairs(
+        bounds[members],
+        pair_mask=None if pair_mask is None else lambda rows, columns: pair_mask(members[rows], members[columns])
+    )
+    left, right = members[left], members[right]
+    owned = _owned(bounds, left, right, region)
+    left, right = left[owned], right[owned]
+
+    buffer, offsets = _worker_state['wkb'], _worker_state['offsets']
+    used = numpy.union1d(left, right)
+    geometries = dict(zip(used, from_wkb([buffer[offsets[position]:offsets[position + 1]] for position in used])))
+    left, right, intersections = _intersect_candidates(geometries, left, right)
+    return left, right, _to_wkb(intersections)
+
+
+def overlap_geometries(geometries, workers: int = None, shard_method: str = 'grid', n_shards: int = None,
+                       pair_mask=None):
+    """
+    Intersects every pair of footprints whose intersection has an area.
+
+    :param geometries: Sequence of shapely footprint polygons
+    :param pair_mask: Optional function ruling out pairs before they are intersected, see candidate_pairs
+    :param workers: Number of worker processes. None or 1 to work in this process.
+    :param shard_method: 'grid' or 'str', see shard_regions
+    :param n_shards: Number of spatial shards. Defaults to 4 per worker, so that workers finishing early can take
+    another shard.
+    :return: (left, right, intersections) left and right are numpy arrays of positions in geometries, with left < right,
+    sorted by left then right. intersections is a list of the Polygon or MultiPolygon overlap of each pair.
+    """
+    geometries = list(geometries)
+    bounds = numpy.array([geometry.bounds for geometry in geometries], dtype=float).reshape(-1, 4)
+    if not workers or workers == 1 or len(geometries) < 2:
+        left, right = candidate_pairs(bounds, pair_mask=pair_mask)
+        return _intersect_candidates(geometries, left, right)
+
+    import multiprocessing
+    wkbs = _to_wkb(geometries)
+    _worker_state.update(
+        bounds=bounds,
+        pair_mask=pair_mask,
+        regions=shard_regions(bounds, n_shards or 4 * workers, shard_method),
+        wkb=b''.join(wkbs),
+        offsets=numpy.concatenate([[0], numpy.cumsum([len(geometry_wkb) for geometry_wkb in wkbs])])
+    )
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            shard_results = pool.map(_shard_pairs, range(len(_worker_state['regions'])), chunksize=1)
+    finally:
+        _worker_state.clear()
+
+    left = numpy.concatenate([result[0] for result in shard_results]).astype(int)
+    right = numpy.concatenate([result[1] for result in shard_results]).astype(int)
+    intersection_wkbs = [geometry_wkb for result in shard_results for geometry_wkb in result[2]]
+    # Ownership already stops pairs being computed by more than one shard, but drop any duplicates from shard borders
+    # all the same. numpy.unique also sorts the pairs into the serial order.
+    _, first = numpy.unique(left * len(geometries) + right, return_index=True)
+    return left[first], right[first], from_wkb([intersection_wkbs[position] for position in first])
+
+
+def build_pairs(footprints, workers: int = None, shard_method: str = 'grid', n_shards: int = None,
+                prefilter: dict = None):
+    """
+    Builds a frame of stereo pair candidates from a frame of footprints, in the form StereoPairSet uses: each column of
+    footprints twice, suffixed _1 and _2, and the overlap polygon in a 'geometry' column.
+
+    :param footprints: GeoDataFrame of footprints and metadata, with a prod_id column
+    :param workers: See overlap_geometries
+    :param shard_method: See overlap_geometries
+    :param n_shards: See overlap_geometries
+    :param prefilter: dict of quality thresholds, see pair_quality.QualityMatrix. Pairs of images which fail them are
+    left out without intersecting their footprints. None to keep every overlapping pair.
+    :return: GeoDataFrame with one row per pair of overlapping footprints, oriented so that prod_id_1 < prod_id_2
+    """
+    import geopandas
+    import pandas
+    footprints = footprints.iloc[numpy.argsort(footprints['prod_id'].to_numpy(), kind='mergesort')]
+    pair_mask = None
+    if prefilter is not None:
+        from nacpl import pair_quality
+        pair_mask = pair_quality.QualityMatrix(pair_quality.image_attributes(footprints), prefilter).block
+    left, right, intersections = overlap_geometries(
+        numpy.asarray(footprints.geometry.values, dtype=object), workers=workers, shard_method=shard_method,
+        n_shards=n_shards, pair_mask=pair_mask
+    )
+    attributes = pandas.DataFrame(footprints.drop(columns=footprints.geometry.name))
+    return geopandas.GeoDataFrame(
+        pandas.concat([
+            attributes.iloc[left].add_suffix('_1').reset_index(drop=True),
+            attributes.iloc[right].add_suffix('_2').reset_index(drop=True)
+        ], axis=1),
+        geometry=intersections,
+        crs=footprints.crs
+    )
@@ -0,0 +1,144 @@
+"""
+Stereo pair quality metrics computed from the metadata of the two images, without their footprints.
+
+The metrics are those of StereoPairSet.stereo_quality and the sun geometry and convergence filters, based on Becker et
+al. 2015, "Criteria for Automated Identification of Stereo Image Pairs". They are written to broadcast, so the same
+functions work on the _1 and _2 columns of a pair frame, or on a block of images against all other images as a matrix.
+QualityMatrix uses the latter to rule out incompatible pairs before any footprints are intersected.
+
+>>> import numpy
+>>> images = {'incidence_angle': numpy.array([40., 45., 80.]), 'emission_angle': numpy.array([0., 5., 10.]),
+...           'north_azimuth': numpy.zeros(3), 'sub_solar_azimuth': numpy.array([90., 95., 90.]),
+...           'resolution': numpy.ones(3)}
+>>> QualityMatrix(images).block(numpy.arange(3), numpy.arange(3)).astype(int).tolist()
+[[1, 1, 0], [1, 1, 0], [0, 0, 1]]
+"""
+
+import numpy
+
+# Thresholds used when pruning pairs before intersecting footprints. These match the defaults of
+# StereoPairSet.filter_sun_geometry, so pruning doesn't change the pairs that pass it. Add any of the other keys of
+# QualityMatrix.block to prune harder.
+default_thresholds = {
+    'max_incidence_angle_difference': 20,
+    'max_sun_azimuth_ground_difference': 20
+}
+
+# Per image metadata the metrics need, as named in ImageSearch.results
+attribute_columns = ('incidence_angle', 'emission_angle', 'north_azimuth', 'sub_solar_azimuth', 'resolution')
+
+
+def incidence_angle_difference(incidence_angle_1, incidence_angle_2):
+    return numpy.abs(incidence_angle_1 - incidence_angle_2)
+
+
+def sun_azimuth_ground_difference(north_azimuth_1, sub_solar_azimuth_1, north_azimuth_2, sub_solar_azimuth_2):
+    """
+    Difference between the images' sub solar azimuths, measured from the ground track rather than from north
+    """
+    return numpy.abs((north_azimuth_1 - sub_solar_azimuth_1) - (north_azimuth_2 - sub_solar_azimuth_2))
+
+
+def convergence(emission_angle_1, emission_angle_2):
+    return numpy.abs(emission_angle_1 - emission_angle_2)
+
+
+def resolution_ratio(resolution_1, resolution_2):
+    return numpy.maximum(resolution_1, resolution_2) / numpy.minimum(resolution_1, resolution_2)
+
+
+def _tip_distance(angle_1, azimuth_1, angle_2, azimuth_2):
+    x1 = - numpy.tan(angle_1) * numpy.cos(azimuth_1)
+    y1 = numpy.tan(angle_1) * numpy.sin(azimuth_1)
+    x2 = - numpy.tan(angle_2) * numpy.cos(azimuth_2)
+    y2 = numpy.tan(angle_2) * numpy.sin(azimuth_2)
+    return ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5
+
+
+def parallax_height_ratio(emission_angle_1, north_azimuth_1, emission_angle_2, north_azimuth_2):
+    """
+    Related to convergence angle ("stereo strength")
+    """
+    return _tip_distance(emission_angle_1, north_azimuth_1, emission_angle_2, north_azimuth_2)
+
+
+def shadow_tip_distance(incidence_angle_1, sub_solar_azimuth_1, incidence_angle_2, sub_solar_azimuth_2):
+    """
+    Measure of illumination compatibility
+    """
+    return _tip_distance(incidence_angle_1, sub_solar_azimuth_1, incidence_angle_2, sub_solar_azimuth_2)
+
+
+def image_attributes(images) -> dict:
+    """
+    :param images: DataFrame of image metadata as in ImageSearch.results
+    :return: dict of attribute name to float numpy array, NaN where a column is missing
+    """
+    return {
+        column: images[column].to_numpy(dtype=float) if column in images else numpy.full(len(images), numpy.nan)
+        for column in attribute_columns
+    }
+
+
+class QualityMatrix:
+    """
+    Evaluates pair quality thresholds for blocks of the matrix of all pairs of images. A pair fails a threshold if
+    either image is missing the metadata it needs, as in the StereoPairSet filters.
+    """
+
+    def __init__(self, attributes: dict, thresholds: dict = None):
+        """
+        :param attributes: dict as returned by image_attributes
+        :param thresholds: dict with any of the keys:
+            max_incidence_angle_difference, max_sun_azimuth_ground_difference: in degrees, see
+                StereoPairSet.filter_sun_geometry
+            min_convergence: in degrees, see StereoPairSet.filter_sufficient_convergence
+            max_resolution_ratio, min_parallax_height_ratio, max_parallax_height_ratio, max_shadow_tip_distance: see
+                StereoPairSet.stereo_quality
+        Defaults to default_thresholds.
+        """
+        self.attributes = attributes
+        self.thresholds = default_thresholds if thresholds is None else thresholds
+
+    def block(self, rows, columns):
+        """
+        :param rows: numpy array of image positions
+        :param columns: numpy array of image positions
+        :return: Boolean numpy array shaped (len(rows), len(columns)), True where the pair of images passes every
+        threshold
+        """
+        first = {name: values[rows][:, None] for name, values in self.attributes.items()}
+        second = {name: values[columns][None, :] for name, values in self.attributes.items()}
+        passes = numpy.ones((len(rows), len(columns)), dtype=bool)
+        # Compare with numpy's NaN semantics silenced, so pairs with missing metadata simply fail
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            thresholds = self.thresholds
+            if thresholds.get('max_incidence_angle_difference') is not None:
+                passes &= incidence_angle_difference(
+                    first['incidence_angle'], second['incidence_angle']
+                ) < thresholds['max_incidence_angle_difference']
+            if thresholds.get('max_sun_azimuth_ground_difference') is not None:
+                passes &= sun_azimuth_ground_difference(
+                    first['north_azimuth'], first['sub_solar_azimuth'],
+                    second['north_azimuth'], second['sub_solar_azimuth']
+                ) < thresholds['max_sun_azimuth_ground_difference']
+            if thresholds.get('min_convergence') is not None:
+                passes &= convergence(first['emission_angle'], second['emission_angle']) > thresholds['min_convergence']
+            if thresholds.get('max_resolution_ratio') is not None:
+                passes &= resolution_ratio(
+                    first['resolution'], second['resolution']
+                ) < thresholds['max_resolution_ratio']
+            if (thresholds.get('min_parallax_height_ratio') is not None or
+                    thresholds.get('max_parallax_height_ratio') is not None):
+                ratio = parallax_height_ratio(first['emission_angle'], first['north_azimuth'],
+                                              second['emission_angle'], second['north_azimuth'])
+                if thresholds.get('min_parallax_height_ratio') is not None:
+                    passes &= ratio > thresholds['min_parallax_height_ratio']
+                if thresholds.get('max_parallax_height_ratio') is not None:
+                    passes &= ratio < thresholds['max_parallax_height_ratio']
+            if thresholds.get('max_shadow_tip_distance') is not None:
+                passes &= shadow_tip_distance(
+                    first['incidence_angle'], first['sub_solar_azimuth'],
+                    second['incidence_angle'], second['sub_solar_azimuth']
+                ) < thresholds['max_shadow_tip_distance']
+        return passes
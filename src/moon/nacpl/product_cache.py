@@ -0,0 +1,342 @@
+"""
+Shared cache of downloaded PDS products, such as NAC EDR .IMG files, for workflow steps on the same node or volume.
+
+Layout of the cache directory:
+
+    objects/ab/abcd...  product files, named by the sha256 of their contents
+    products/M1234567890LE.json  which object holds each product id, with its original filename and size. The file's
+        modification time records when the product was last used, for least recently used (LRU) eviction.
+    locks/  lock files, so that concurrent steps wait for each other rather than downloading the same product twice,
+        and so that an object is never removed while it is being added or linked. Lock files are removed along with
+        their product or object on eviction.
+    stats.json  hit, miss and eviction counts
+
+Objects are read-only. Products are handed out as hard links into each step's working directory, so a step never copies
+the data unless it is on a different file system from the cache. A hard link shares the object's inode, so a step must
+never make it writable and modify it, which would corrupt the cache for every other step; ask for a copy instead if a
+step needs to. Evicting a product doesn't affect steps already holding a hard link or copy of it.
+
+>>> import tempfile
+>>> work_dir = tempfile.mkdtemp()
+>>> def download(product_id, directory):
+...     path = os.path.join(directory, product_id + '.IMG')
+...     with open(path, 'w') as f:
+...         f.write(product_id * 4)
+...     return path
+>>> cache = ProductCache(os.path.join(work_dir, 'cache'), max_bytes=100)
+>>> path = cache.fetch('M1LE', work_dir, download)
+>>> path = cache.fetch('M1LE', work_dir, download)
+>>> open(path).read()
+'M1LEM1LEM1LEM1LE'
+>>> cache.stats()
+{'hits': 1, 'misses': 1, 'evictions': 0, 'bytes_downloaded': 16}
+
+Products beyond max_bytes are evicted least recently used first, along with their lock files:
+
+>>> cache.max_bytes = 40
+>>> os.utime(cache._entry_path('M1LE'), (0, 0))
+>>> path = cache.fetch('M2RE', work_dir, download)
+>>> path = cache.fetch('M3RE', work_dir, download)
+>>> sorted(os.listdir(os.path.join(cache.cache_dir, 'products'))), cache.stats()['evictions']
+(['M2RE.json', 'M3RE.json'], 1)
+>>> os.path.exists(cache._product_lock_path('M1LE'))
+False
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+@contextlib.contextmanager
+def _locked(lock_path: str, blocking: bool = True):
+    """
+    Holds an exclusive lock on lock_path for the duration of the with block. Works across processes and pods, as long
+    as the file system supports flock.
+
+    :param blocking: Wait for the lock. If False and another process holds it, don't wait.
+    :return: Context manager giving True if the lock is held, or False if blocking is False and it is held elsewhere
+    """
+    while True:
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                # Lock files are removed on eviction, so the file locked may have been unlinked while waiting for it. A
+                # lock on an unlinked file excludes nobody, so retry with the current file.
+                try:
+                    current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    yield True
+                    return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_json_atomic(path: str, data: dict) -> None:
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(tmp_fd, 'w') as tmp_file:
+        json.dump(data, tmp_file)
+    os.replace(tmp_path, path)
+
+
+def sha256sum(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    :return: Hex sha256 digest of the file at path
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProductCache:
+    """
+    Content addressed cache of downloaded products, keyed by product id and sha256, with size bounded LRU eviction.
+    Safe to use from many processes at once.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        """
+        :param cache_dir: Directory holding the cache, e.g. on a volume shared by the workflow's pods
+        :param max_bytes: Evict least recently used products once the cache holds more than this. None for no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        for subdir in ('objects', 'products', 'locks', 'tmp'):
+            os.makedirs(os.path.join(cache_dir, subdir), exist_ok=True)
+
+    def _entry_path(self, product_id: str) -> str:
+        return os.path.join(self.cache_dir, 'products', f'{product_id}.json')
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256)
+
+    def _product_lock_path(self, product_id: str) -> str:
+        return os.path.join(self.cache_dir, 'locks', f'{product_id}.lock')
+
+    def _product_lock(self, product_id: str, blocking: bool = True):
+        return _locked(self._product_lock_path(product_id), blocking=blocking)
+
+    def _object_lock_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, 'locks', f'object-{sha256}.lock')
+
+    def _object_lock(self, sha256: str, blocking: bool = True):
+        """
+        Held while an object is moved into place, linked or copied out, or removed. Taken after the product lock.
+        """
+        return _locked(self._object_lock_path(sha256), blocking=blocking)
+
+    def _cache_lock(self):
+        return _locked(os.path.join(self.cache_dir, 'locks', 'cache.lock'))
+
+    def _read_entry(self, product_id: str):
+        try:
+            with open(self._entry_path(product_id)) as entry_file:
+                return json.load(entry_file)
+        except FileNotFoundError:
+            return None
+
+    def _update_stats(self, **increments) -> None:
+        with self._cache_lock():
+            stats = self.stats()
+            for key, increment in increments.items():
+                stats[key] = stats.get(key, 0) + increment
+            _write_json_atomic(os.path.join(self.cache_dir, 'stats.json'), stats)
+
+    def stats(self) -> dict:
+        """
+        :return: dict of counts: hits, misses, evictions and bytes_downloaded
+        """
+        try:
+            with open(os.path.join(self.cache_dir, 'stats.json')) as stats_file:
+                return json.load(stats_file)
+        except FileNotFoundError:
+            return {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_downloaded': 0}
+
+    def _is_valid(self, entry: dict, verify: bool) -> bool:
+        object_path = self._object_path(entry['sha256'])
+        if not os.path.exists(object_path) or os.path.getsize(object_path) != entry['size']:
+            return False
+        return not verify or sha256sum(object_path) == entry['sha256']
+
+    def _place(self, entry: dict, dest_dir: str, link: str) -> str:
+        """
+        Links or copies an object into dest_dir. Call with the object lock held.
+
+        :return: Path of the product in dest_dir
+        """
+        object_path = self._object_path(entry['sha256'])
+        dest_path = os.path.join(dest_dir, entry['filename'])
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        if link == 'symbolic':
+            os.symlink(object_path, dest_path)
+        elif link == 'hard':
+            try:
+                os.link(object_path, dest_path)
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(object_path, dest_path)
+        else:
+            shutil.copyfile(object_path, dest_path)
+        return dest_path
+
+    def _populate(self, product_id: str, download, dest_dir: str, link: str):
+        """
+        Downloads a product into a private temporary directory, then moves it into place, so other processes never see
+        a partial file, and places it in dest_dir. The object lock is held from moving the object into place until it
+        is placed, so a concurrent eviction of another product with the same contents can't remove it in between.
+
+        :return: (entry, path of the product in dest_dir)
+        """
+        tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.cache_dir, 'tmp'))
+        try:
+            downloaded_path = download(product_id, tmp_dir)
+            entry = {
+                'sha256': sha256sum(downloaded_path),
+                'filename': os.path.basename(downloaded_path),
+                'size': os.path.getsize(downloaded_path)
+            }
+            object_path = self._object_path(entry['sha256'])
+            os.chmod(downloaded_path, 0o444)
+            with self._object_lock(entry['sha256']):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(downloaded_path, object_path)
+                _write_json_atomic(self._entry_path(product_id), entry)
+                dest_path = self._place(entry, dest_dir, link)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return entry, dest_path
+
+    def fetch(self, product_id: str, dest_dir: str, download, link: str = 'hard', verify: bool = False) -> str:
+        """
+        Places a product in dest_dir, downloading it only if it isn't already cached.
+
+        :param product_id: PDS id of the product, for example M1134059748RE
+        :param dest_dir: Directory the product should appear in
+        :param download: Function called as download(product_id, directory) on a cache miss, which downloads the
+        product into directory and returns the path of the downloaded file
+        :param link: 'hard' to hard link the read-only cached file into dest_dir, falling back to a copy if dest_dir is
+        on a different file system, 'copy' to always copy it, for steps which modify the product in place, or
+        'symbolic' to symlink it. Symbolic links break if the product is later evicted, so only use them if the cache
+        is unbounded or the step finishes with the product quickly.
+        :param verify: Check the sha256 of the cached file on a hit, rather than only its size
+        :return: Path of the product in dest_dir
+        """
+        if link not in ('copy', 'hard', 'symbolic'):
+            raise ValueError(f"link must be 'copy', 'hard' or 'symbolic', not {link!r}")
+        with self._product_lock(product_id):
+            entry = self._read_entry(product_id)
+            hit = False
+            if entry is not None:
+                with self._object_lock(entry['sha256']):
+                    # Checked under the object lock, so the object can't be evicted before it is placed
+                    hit = self._is_valid(entry, verify)
+                    if hit:
+                        dest_path = self._place(entry, dest_dir, link)
+            if not hit:
+                entry, dest_path = self._populate(product_id, download, dest_dir, link)
+            # Record the access for LRU eviction
+            os.utime(self._entry_path(product_id))
+
+        if hit:
+            self._update_stats(hits=1)
+        else:
+            self._update_stats(misses=1, bytes_downloaded=entry['size'])
+            self.evict(keep=(product_id,))
+        return dest_path
+
+    def _new_users(self, sha256: str, known: dict) -> set:
+        """
+        :param known: dict of object sha256 to the set of product ids known to use it
+        :return: set of ids of the products, other than those in known, which use the object sha256
+        """
+        known_ids = set().union(*known.values())
+        users = set()
+        for entry_filename in os.listdir(os.path.join(self.cache_dir, 'products')):
+            product_id = entry_filename[:-len('.json')]
+            if not entry_filename.endswith('.json') or product_id in known_ids:
+                continue
+            entry = self._read_entry(product_id)
+            if entry is not None and entry['sha256'] == sha256:
+                users.add(product_id)
+        return users
+
+    def evict(self, keep=()) -> int:
+        """
+        Removes least recently used products until the cache is no bigger than max_bytes. Products another process is
+        fetching, or whose object is being added or placed, are skipped rather than waited for, so eviction never holds
+        up the cache lock.
+
+        :param keep: Product ids which must not be evicted
+        :return: Number of products evicted
+        """
+        if self.max_bytes is None:
+            return 0
+        with self._cache_lock():
+            products_dir = os.path.join(self.cache_dir, 'products')
+            entries = []
+            for entry_filename in os.listdir(products_dir):
+                if not entry_filename.endswith('.json'):
+                    continue
+                product_id = entry_filename[:-len('.json')]
+                entry = self._read_entry(product_id)
+                if entry is None:
+                    continue
+                entries.append((os.path.getmtime(self._entry_path(product_id)), product_id, entry))
+
+            # Several product ids may share an object, so count each object once
+            object_users = {}
+            object_sizes = {}
+            for _, product_id, entry in entries:
+                object_users.setdefault(entry['sha256'], set()).add(product_id)
+                object_sizes[entry['sha256']] = entry['size']
+            total_bytes = sum(object_sizes.values())
+
+            evicted = 0
+            for _, product_id, entry in sorted(entries, key=lambda e: e[0]):
+                if total_bytes <= self.max_bytes:
+                    break
+                if product_id in keep:
+                    continue
+                sha256 = entry['sha256']
+                with self._product_lock(product_id, blocking=False) as product_locked, \
+                        self._object_lock(sha256, blocking=False) as object_locked:
+                    if not (product_locked and object_locked):
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._entry_path(product_id))
+                    users = object_users[sha256]
+                    users.discard(product_id)
+                    # Products added since the entries were listed may also use the object. Their entries were written
+                    # under the object lock, so they are visible now.
+                    users.update(self._new_users(sha256, known=object_users))
+                    if not users:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(self._object_path(sha256))
+                        total_bytes -= entry['size']
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(self._object_lock_path(sha256))
+                    # Removed while held, so processes waiting on it retry with a new lock file, see _locked
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._product_lock_path(product_id))
+                evicted += 1
+
+            if evicted:
+                stats = self.stats()
+                stats['evictions'] = stats.get('evictions', 0) + evicted
+                _write_json_atomic(os.path.join(self.cache_dir, 'stats.json'), stats)
+        return evicted
@@ -0,0 +1,314 @@
+"""
+Cache of ImageSearch results, so that repeated or nested searches don't query ODE and reload CUMINDEX.TAB again.
+
+Searches are keyed on a normalized form of the search polygon, the projection and the index files, including each
+index file's modification time and size, so that updating CUMINDEX.TAB makes earlier results stale. A search whose
+polygon lies inside the polygon of a cached search with the same projection is answered from the cached results, by
+keeping the footprints which intersect the new polygon, because ODE returns every footprint intersecting the search
+polygon.
+
+Results are kept in process, and optionally in a directory shared between runs:
+
+    <key>.pkl  pickled results. The file's modification time records when they were last used, for least recently used
+        (LRU) eviction.
+    <key>.json  the search polygon, projection, index files and creation time, read to find searches containing a new
+        one without unpickling every entry
+
+Entries older than the cache's max_age are neither used nor kept, so newly released NACs appear even if the index files
+are updated in place without their modification times changing.
+
+>>> normalize_polygon('POLYGON ((1 0, 1 1, 0 1, 0 0, 1 0))', precision=1)
+'POLYGON ((0.0 0.0, 1.0 0.0, 1.0 1.0, 0.0 1.0, 0.0 0.0))'
+
+A search inside a cached south polar search returns the footprints a direct search in longitude, latitude would:
+
+>>> import geopandas
+>>> from shapely.geometry import box
+>>> from nacpl import geom_helpers
+>>> lonlat = [box(lon, lat, lon + 1, lat + 1) for lon in range(0, 60, 2) for lat in range(-86, -78)]
+>>> footprints = geopandas.GeoDataFrame(
+...     {'prod_id': range(len(lonlat))},
+...     geometry=[geom_helpers.lonlat_polygon_to_projection(footprint, 'sp') for footprint in lonlat]
+... )
+>>> cache = ImageSearchCache(tempfile.mkdtemp())
+>>> cache.put(box(0, -86, 60, -78).wkt, footprints, 'sp')
+>>> search = box(10.5, -83.5, 29.5, -81.5)
+>>> new_run = ImageSearchCache(cache.cache_dir)
+>>> results = new_run.get(search.wkt, 'sp')
+>>> sorted(results.prod_id) == [prod_id for prod_id, footprint in enumerate(lonlat) if footprint.intersects(search)]
+True
+>>> new_run.get(search.wkt, 'sp') is not None, new_run.stats()
+(True, {'hits': 1, 'subsumed': 1, 'misses': 0})
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+
+# Decimal places of degrees kept when normalizing search polygons. 1e-6 degrees is about 3 cm on the Moon.
+polygon_precision = 6
+
+
+def _normalize_ring(coords, precision: int) -> list:
+    """
+    Rounds a closed ring's coordinates and rotates it to start at its smallest vertex.
+    """
+    ring = [(round(x, precision), round(y, precision)) for x, y in list(coords)[:-1]]
+    start = ring.index(min(ring))
+    ring = ring[start:] + ring[:start]
+    return ring + ring[:1]
+
+
+def normalize_polygon(polygon_wkt: str, precision: int = polygon_precision) -> str:
+    """
+    Normalizes a search polygon, so that the same polygon written with a different starting vertex, winding order or
+    insignificant digits gives the same cache key.
+
+    :param polygon_wkt: WKT of a shapely Polygon
+    :param precision: Decimal places kept
+    :return: WKT of the normalized polygon
+    """
+    from shapely import wkt
+    from shapely.geometry import Polygon
+    from shapely.geometry.polygon import orient
+    polygon = wkt.loads(polygon_wkt)
+    if polygon.geom_type != 'Polygon':
+        return wkt.dumps(polygon, rounding_precision=precision)
+    polygon = orient(polygon, sign=1.0)
+    polygon = Polygon(
+        _normalize_ring(polygon.exterior.coords, precision),
+        [_normalize_ring(interior.coords, precision) for interior in polygon.interiors]
+    )
+    return wkt.dumps(polygon, rounding_precision=precision)
+
+
+def index_fingerprint(index_files: tuple) -> list:
+    """
+    :param index_files: Paths of the files search results were derived from
+    :return: list of [path, modification time in ns, size] for each file, with None for the time and size of missing
+    files
+    """
+    fingerprint = []
+    for index_file in index_files:
+        try:
+            stat = os.stat(index_file)
+            fingerprint.append([index_file, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            fingerprint.append([index_file, None, None])
+    return fingerprint
+
+
+def search_key(polygon_wkt: str, projection: str, index_files: tuple) -> str:
+    """
+    :return: Hex digest identifying a search, which changes if any of index_files is modified
+    """
+    description = json.dumps([normalize_polygon(polygon_wkt), projection, index_fingerprint(index_files)])
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+class ImageSearchCache:
+    """
+    LRU cache of ImageSearch results, in process and, if cache_dir is given, on disk.
+    """
+
+    def __init__(self, cache_dir: str = None, max_entries: int = 64, max_memory_entries: int = 8,
+                 max_age: float = 7 * 24 * 3600):
+        """
+        :param cache_dir: Directory to keep results in between runs. None to only cache in process.
+        :param max_entries: Most searches kept in cache_dir
+        :param max_memory_entries: Most searches kept in process. Polar searches can hold thousands of footprints, so
+        keep this small.
+        :param max_age: Seconds after which a cached search expires, however recently it was used. None for no limit.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_memory_entries = max_memory_entries
+        self.max_age = max_age
+        # key: (search description, results)
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.subsumed = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, key + extension)
+
+    def _expired(self, description: dict) -> bool:
+        return self.max_age is not None and time.time() - description.get('created', 0) > self.max_age
+
+    def _remove(self, key: str) -> None:
+        self.memory.pop(key, None)
+        if self.cache_dir is not None:
+            for extension in ('.json', '.pkl'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(key, extension))
+
+    def _remember(self, key: str, description: dict, results) -> None:
+        self.memory[key] = (description, results)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _load(self, key: str):
+        """
+        :return: (description, results) from memory or cache_dir, or None
+        """
+        if key in self.memory:
+            if self._expired(self.memory[key][0]):
+                self._remove(key)
+                return None
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(key, '.json')) as description_file:
+                description = json.load(description_file)
+            if self._expired(description):
+                self._remove(key)
+                return None
+            with open(self._path(key, '.pkl'), 'rb') as results_file:
+                results = pickle.load(results_file)
+        except (FileNotFoundError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        # Record the access for LRU eviction
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self._path(key, '.pkl'))
+        self._remember(key, description, results)
+        return description, results
+
+    def _descriptions(self):
+        """
+        :return: dict of key to search description, for every search in memory or cache_dir
+        """
+        descriptions = {key: description for key, (description, _) in self.memory.items()}
+        if self.cache_dir is not None:
+            for filename in os.listdir(self.cache_dir):
+                key, extension = os.path.splitext(filename)
+                if extension != '.json' or key in descriptions:
+                    continue
+                with contextlib.suppress(FileNotFoundError, ValueError):
+                    with open(os.path.join(self.cache_dir, filename)) as description_file:
+                        descriptions[key] = json.load(description_file)
+        return descriptions
+
+    def _containing_search(self, polygon_wkt: str, projection: str, index_files: tuple):
+        """
+        :return: key of the smallest unexpired cached search, made with the same versions of index_files, whose polygon
+        contains polygon_wkt, or None
+        """
+        from shapely import wkt
+        polygon = wkt.loads(polygon_wkt)
+        fingerprint = index_fingerprint(index_files)
+        containing = []
+        for key, description in self._descriptions().items():
+            if (description['projection'] != projection or description['index_files'] != fingerprint or
+                    self._expired(description)):
+                continue
+            cached_polygon = wkt.loads(description['polygon'])
+            if cached_polygon.contains(polygon):
+                containing.append((cached_polygon.area, key))
+        return min(containing)[1] if containing else None
+
+    def get(self, polygon_wkt: str, projection: str = 'ec', index_files: tuple = ()):
+        """
+        :param polygon_wkt: WKT of the search polygon, in longitude, latitude degrees as sent to ODE
+        :param projection: Projection of the footprints, see find_stereo_pairs.projections
+        :param index_files: Paths of the CUMINDEX.TAB and INDEX.LBL files the metadata came from
+        :return: GeoDataFrame of results, or None if the search must be made
+        """
+        key = search_key(polygon_wkt, projection, index_files)
+        cached = self._load(key)
+        if cached is not None:
+            self.hits += 1
+            return cached[1].copy()
+
+        containing_key = self._containing_search(polygon_wkt, projection, index_files)
+        cached = self._load(containing_key) if containing_key is not None else None
+        if cached is None:
+            self.misses += 1
+            return None
+        from shapely import wkt
+        from nacpl import geom_helpers
+        self.subsumed += 1
+        cached_results = cached[1]
+        query = geom_helpers.lonlat_polygon_to_projection(wkt.loads(polygon_wkt), projection)
+        results = cached_results.loc[cached_results.geometry.intersects(query)].copy()
+        self.put(polygon_wkt, results, projection, index_files)
+        return results
+
+    def put(self, polygon_wkt: str, results, projection: str = 'ec', index_files: tuple = ()) -> None:
+        """
+        Stores the results of a search. See get for the parameters.
+        """
+        key = search_key(polygon_wkt, projection, index_files)
+        description = {'polygon': polygon_wkt, 'projection': projection,
+                       'index_files': index_fingerprint(index_files), 'created': time.time()}
+        # Copied so that callers modifying their results don't change the cached ones
+        self._remember(key, description, results.copy())
+        if self.cache_dir is None:
+            return
+        # Write to temporary files and rename, so concurrent runs never read a partial entry. The results go first, as
+        # the description is what makes an entry visible to _containing_search.
+        for extension, mode, dump, data in (('.pkl', 'wb', pickle.dump, results),
+                                             ('.json', 'w', json.dump, description)):
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(tmp_fd, mode) as tmp_file:
+                dump(data, tmp_file)
+            os.replace(tmp_path, self._path(key, extension))
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes expired searches, then least recently used searches from cache_dir until it holds no more than
+        max_entries.
+
+        :return: Number of searches evicted
+        """
+        evicted = 0
+        for key, (description, _) in list(self.memory.items()):
+            if self._expired(description):
+                self._remove(key)
+                evicted += 1
+        if self.cache_dir is None:
+            return evicted
+        expired = [key for key, description in self._descriptions().items() if self._expired(description)]
+        for key in expired:
+            self._remove(key)
+        evicted += len(expired)
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            key, extension = os.path.splitext(filename)
+            if extension == '.pkl':
+                with contextlib.suppress(FileNotFoundError):
+                    entries.append((os.path.getmtime(os.path.join(self.cache_dir, filename)), key))
+        for _, key in sorted(entries)[:max(len(entries) - self.max_entries, 0)]:
+            self._remove(key)
+            evicted += 1
+        return evicted
+
+    def stats(self) -> dict:
+        """
+        :return: dict of counts of this process's lookups: hits, subsumed (answered from a containing search) and misses
+        """
+        return {'hits': self.hits, 'subsumed': self.subsumed, 'misses': self.misses}
+
+
+# One cache per cache directory (None for in process only), shared by every ImageSearch in the process
+_caches = {}
+
+
+def get_cache(cache_dir: str = None) -> ImageSearchCache:
+    """
+    :return: The process wide ImageSearchCache for cache_dir
+    """
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ImageSearchCache(cache_dir)
+    return _caches[cache_dir]
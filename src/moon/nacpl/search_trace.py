@@ -0,0 +1,230 @@
+"""
+Records the progress of geom_helpers.covering_set_search and renders it as figures after the search has finished.
+
+Recording is cheap enough to do on every search: each step stores a handful of numbers in preallocated numpy arrays.
+All matplotlib work happens in render_trace, which can run in a background process via render_trace_in_background so
+that diagnostic runs of the search take no longer than normal ones.
+"""
+
+import os
+import tempfile
+import numpy
+
+default_output_dir = os.path.join(tempfile.gettempdir(), 'coversearch')
+
+
+class CoveringSearchTrace:
+    """
+    Compact trace of a covering set search. After n steps, the arrays below each have length n:
+
+    x, y: coordinates of the search point tried at each step
+    hit: whether any polygon contained the search point
+    selected: position (as used by DataFrame.iloc) in the searched polygon set of the polygon selected at that step, or
+        -1 for a miss
+    coverage_fraction: fraction of the search polygon covered after that step
+    """
+
+    def __init__(self, capacity: int = 64):
+        self._n = 0
+        self._x = numpy.empty(capacity, dtype=float)
+        self._y = numpy.empty(capacity, dtype=float)
+        self._hit = numpy.empty(capacity, dtype=bool)
+        self._selected = numpy.empty(capacity, dtype=numpy.int64)
+        self._coverage_fraction = numpy.empty(capacity, dtype=float)
+
+    def __len__(self):
+        return self._n
+
+    def record(self, x: float, y: float, hit: bool, selected: int, coverage_fraction: float) -> None:
+        """
+        Appends one search step to the trace.
+
+        :param x: x coordinate of the search point
+        :param y: y coordinate of the search point
+        :param hit: whether a polygon containing the search point was found
+        :param selected: iloc position of the selected polygon, or -1 if there was no hit
+        :param coverage_fraction: fraction of the search polygon covered after this step
+        """
+        if self._n == len(self._x):
+            self._grow()
+        self._x[self._n] = x
+        self._y[self._n] = y
+        self._hit[self._n] = hit
+        self._selected[self._n] = selected
+        self._coverage_fraction[self._n] = coverage_fraction
+        self._n += 1
+
+    def _grow(self) -> None:
+        for name in ('_x', '_y', '_hit', '_selected', '_coverage_fraction'):
+            old = getattr(self, name)
+            new = numpy.empty(len(old) * 2, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    @property
+    def x(self):
+        return self._x[:self._n]
+
+    @property
+    def y(self):
+        return self._y[:self._n]
+
+    @property
+    def hit(self):
+        return self._hit[:self._n]
+
+    @property
+    def selected(self):
+        return self._selected[:self._n]
+
+    @property
+    def coverage_fraction(self):
+        return self._coverage_fraction[:self._n]
+
+    def selected_positions(self):
+        """
+        :return: numpy array of the iloc positions of the selected polygons, in the order they were selected
+        """
+        return self.selected[self.hit]
+
+    def save(self, path: str) -> None:
+        """
+        Saves the trace as a numpy .npz file
+        """
+        numpy.savez(path, x=self.x, y=self.y, hit=self.hit, selected=self.selected,
+                    coverage_fraction=self.coverage_fraction)
+
+    @classmethod
+    def load(cls, path: str) -> 'CoveringSearchTrace':
+        """
+        Loads a trace saved with CoveringSearchTrace.save
+        """
+        arrays = numpy.load(path)
+        trace = cls(capacity=max(len(arrays['x']), 1))
+        for x, y, hit, selected, coverage_fraction in zip(arrays['x'], arrays['y'], arrays['hit'],
+                                                          arrays['selected'], arrays['coverage_fraction']):
+            trace.record(x, y, hit, selected, coverage_fraction)
+        return trace
+
+
+def _plot_polygon(ax, geometry, **kwargs):
+    """
+    Draws a shapely Polygon or MultiPolygon with plain matplotlib, returning the artists.
+    """
+    polygons = getattr(geometry, 'geoms', [geometry])
+    artists = []
+    for polygon in polygons:
+        x, y = polygon.exterior.xy
+        artists += ax.fill(x, y, **kwargs)
+    return artists
+
+
+def render_trace(trace: CoveringSearchTrace, geometries: dict, search_poly, output_dir: str = default_output_dir,
+                 every: int = 1, labels: dict = None, animation: str = None, dpi: int = 100) -> None:
+    """
+    Draws the progress of a covering set search, step by step. Each frame shows the search polygon, every polygon
+    selected so far and the search points tried so far, with hits and misses distinguished.
+
+    The figure is built up incrementally, adding only what changed since the previous step, so rendering costs
+    O(steps) rather than redrawing every selected polygon for each frame.
+
+    :param trace: The trace recorded during the search
+    :param geometries: dict of iloc position to shapely geometry, for (at least) the selected polygons
+    :param search_poly: shapely Polygon that was searched
+    :param output_dir: Directory to write frames into. Created if it doesn't exist.
+    :param every: Only write every nth step as a frame (the final step is always written)
+    :param labels: Optional dict of iloc position to legend label, e.g. the pair id
+    :param animation: Optional filename, relative to output_dir, for an animated GIF of the frames. If given, no
+    individual frames are written.
+    :param dpi: Resolution of the output
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    os.makedirs(output_dir, exist_ok=True)
+    labels = labels or {}
+    fig, ax = pyplot.subplots()
+    ax.set_aspect('equal')
+    for polygon in getattr(search_poly, 'geoms', [search_poly]):
+        x, y = polygon.exterior.xy
+        ax.plot(x, y, color='k')
+
+    writer = None
+    if animation:
+        from matplotlib.animation import PillowWriter
+        writer = PillowWriter(fps=5)
+        writer.setup(fig, os.path.join(output_dir, animation), dpi=dpi)
+
+    color_cycle = pyplot.rcParams['axes.prop_cycle'].by_key()['color']
+    n_steps = len(trace)
+    hit_steps = [step for step in range(n_steps) if trace.hit[step]]
+
+    # The legend is made once, with an entry for every polygon the search selects, and each entry is shown as its
+    # polygon is drawn. Animation frames have a fixed size, so they have no legend.
+    legend_entries = {}
+    if not writer:
+        from matplotlib.patches import Patch
+        handles = [Patch(color=color_cycle[step % len(color_cycle)], alpha=0.4,
+                         label=str(labels.get(int(trace.selected[step]), int(trace.selected[step]))))
+                   for step in hit_steps]
+        if handles:
+            legend = ax.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5))
+            legend_handles = getattr(legend, 'legend_handles', None) or legend.legendHandles
+            for step, handle, text in zip(hit_steps, legend_handles, legend.get_texts()):
+                handle.set_visible(False)
+                text.set_visible(False)
+                legend_entries[step] = (handle, text)
+
+    for step in range(n_steps):
+        if trace.hit[step]:
+            position = int(trace.selected[step])
+            _plot_polygon(ax, geometries[position], alpha=0.4, color=color_cycle[step % len(color_cycle)])
+            for artist in legend_entries.get(step, ()):
+                artist.set_visible(True)
+            ax.plot(trace.x[step], trace.y[step], marker='+', color='k')
+        else:
+            ax.plot(trace.x[step], trace.y[step], marker='x', color='r')
+
+        if step % every == 0 or step == n_steps - 1:
+            ax.set_title(f'Step {step + 1}, coverage {trace.coverage_fraction[step]:.3f}')
+            if writer:
+                writer.grab_frame()
+            else:
+                fig.savefig(os.path.join(output_dir, f'{step + 1:05d}.png'), dpi=dpi, bbox_inches='tight')
+
+    if writer:
+        writer.finish()
+    pyplot.close(fig)
+
+
+def render_trace_in_background(trace: CoveringSearchTrace, geometries: dict, search_poly, **kwargs):
+    """
+    Runs render_trace in a separate process, so the caller can carry on while the figures are drawn. Takes the same
+    arguments as render_trace.
+
+    :return: The started multiprocessing.Process; join() it to wait for rendering to finish
+    """
+    import multiprocessing
+    process = multiprocessing.Process(
+        target=render_trace,
+        args=(trace, geometries, search_poly),
+        kwargs=kwargs
+    )
+    process.start()
+    return process
+
+
+def wait_for_rendering(stats: dict) -> None:
+    """
+    Waits for the figures of a covering set search started with plot=True to be drawn.
+
+    :param stats: stats as returned by geom_helpers.covering_set_search. Nothing is waited for if there was no plot.
+    :raises RuntimeError: if rendering failed
+    """
+    process = stats.get('render_process')
+    if process is None:
+        return
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Rendering the covering set search failed, exit code {process.exitcode}')
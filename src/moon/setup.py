@@ -8,5 +8,16 @@ setup(
     license='',
     author='Aaron Curtis',
     author_email='aaron.curtis@jpl.nasa.gov',
-    description='Python components to be used with the NAC Pipeline, a component of the Solar System Treks Mosaic Pipeline'
+    description='Python components to be used with the NAC Pipeline, a component of the Solar System Treks Mosaic Pipeline',
+    entry_points={
+        'console_scripts': [
+            'nacpl-find-stereo-pairs=nacpl.find_stereo_pairs:main',
+            'nacpl-find-nacs-mono=nacpl.find_nacs_mono:main',
+            'nacpl-mosaic-merge=nacpl.mosaic_merge:main',
+            'nacpl-download-nac=nacpl.download_NAC:main',
+            'nacpl-download-lola=nacpl.download_LOLA:main',
+            'nacpl-build-footprint-store=nacpl.footprint_store:main',
+            'nacpl-import-benchmark=nacpl.import_benchmark:main',
+        ]
+    }
 )